@@ -3,15 +3,45 @@ import openai
 import anthropic
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 import datetime
 import pytz
 import difflib
+import heapq
+import math
+import operator
+import os
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import re
+import threading
+import time
+import logging
+import hashlib
+import functools
+import random
+import json
+import atexit
+import sqlite3
+import io
+import wave
+import shutil
+import subprocess
+import warnings
+from dataclasses import dataclass, field
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore", DeprecationWarning)
+    try:
+        import audioop  # 音声前処理用（Python 3.13で削除。無ければ前処理を省略する）
+    except ImportError:
+        audioop = None
 
 # ---------------------------------------------------------
 # 1. 設定 & デザイン
 # ---------------------------------------------------------
 st.set_page_config(page_title="連絡帳メーカー", layout="wide")
 JST = pytz.timezone('Asia/Tokyo')
+logger = logging.getLogger("contact_book")
 
 st.markdown("""
 <style>
@@ -55,193 +85,1421 @@ def get_gsp_service():
     creds = service_account.Credentials.from_service_account_info(st.secrets["gcp_service_account"], scopes=SCOPES)
     return build('sheets', 'v4', credentials=creds)
 
+# Sheet1スナップショットの有効期間（秒）。自プロセスの書き込みは即時反映されるため、
+# 他プロセス・手動編集の反映待ち時間の上限として効く
+SHEET_CACHE_TTL = float(st.secrets.get("SHEET_CACHE_TTL", 30))
+# 末尾同期では拾えない既存行の手動編集・削除を反映するための全件再取得の間隔（秒）
+SHEET_FULL_SYNC_INTERVAL = float(st.secrets.get("SHEET_FULL_SYNC_INTERVAL", 600))
+# save_memo / save_ai_draft_temp の書き込みをまとめて送る間隔（秒）。0以下ならその場で書き込む
+WRITE_FLUSH_INTERVAL = float(st.secrets.get("WRITE_FLUSH_INTERVAL", 2))
+# 送信待ちの行を残しておくファイル（再起動後に再送する）
+WRITE_SPOOL_PATH = st.secrets.get("WRITE_SPOOL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".sheet1_write_spool.jsonl"))
+# 連絡帳の確定・職員設定の送信中に、保存結果を確認する間隔（秒）。0なら画面を操作したときだけ確認する
+SAVE_STATUS_POLL_SECONDS = float(st.secrets.get("SAVE_STATUS_POLL_SECONDS", 2))
+# Sheet1 I列: AIドラフトからの修正量スコア（save_final_report で記入）
+LOG_DIFF_SCORE_COL = 8
+# get_high_diff_examples 用に職員ごとに保持する修正量上位件数
+DIFF_TOP_K = 10
+# 修正量の採点方式: "exact"（difflibで厳密・上位に入らないと分かった行は採点しない）/ "prefilter"（近似で候補を絞ってから厳密。上位件数は近似）/ "ngram"（近似のみ）
+DIFF_SCORING_MODE = st.secrets.get("DIFF_SCORING_MODE", "exact")
+# これ以上の文字数のドラフトは bigram 近似で採点する（0で無効）
+DIFF_NGRAM_MIN_CHARS = int(st.secrets.get("DIFF_NGRAM_MIN_CHARS", 0))
+# prefilter モードで厳密に採点する候補数（上位件数の何倍か）
+DIFF_PREFILTER_FACTOR = 3
+# この件数以上をまとめて採点するときはプロセスプールを使う
+DIFF_POOL_MIN_PAIRS = 64
+# member シート（児童・職員一覧と職員設定）のキャッシュ有効期間（秒）
+STAFF_CACHE_TTL = float(st.secrets.get("STAFF_CACHE_TTL", 300))
+# これより古いキャッシュの行番号で書き込むときは、B列1セルを読んで職員名を確認する（秒）
+STAFF_VERIFY_AFTER = float(st.secrets.get("STAFF_VERIFY_AFTER", 60))
+# 録音をWhisperへ送る前に無音カット・16kHzモノラル化する
+AUDIO_PREPROCESS = bool(st.secrets.get("AUDIO_PREPROCESS", True))
+# 前処理後の音声をffmpegで圧縮するコーデック（"opus" / "mp3"、空なら16kHzモノラルWAVのまま）
+AUDIO_ENCODE_CODEC = st.secrets.get("AUDIO_ENCODE_CODEC", "")
+# 長い録音はこの秒数前後のチャンクに分けて並列に文字起こしする
+AUDIO_CHUNK_SECONDS = float(st.secrets.get("AUDIO_CHUNK_SECONDS", 45))
+AUDIO_CHUNK_OVERLAP_SECONDS = 1.0
+AUDIO_CHUNK_WORKERS = int(st.secrets.get("AUDIO_CHUNK_WORKERS", 4))
+# 前のチャンクの文字起こしから次のチャンクのpromptに渡す文字数
+AUDIO_PROMPT_TAIL_CHARS = 50
+# 文字起こし結果キャッシュの上限（テキストの合計バイト数）と保存先ディレクトリ（空ならメモリのみ）
+TRANSCRIPT_CACHE_MAX_BYTES = int(st.secrets.get("TRANSCRIPT_CACHE_MAX_BYTES", 4 * 1024 * 1024))
+TRANSCRIPT_CACHE_DIR = st.secrets.get("TRANSCRIPT_CACHE_DIR", "")
+# 一括ドラフト作成の同時実行数と、LLM呼び出しの上限（1分あたりの回数）。0以下は1として扱う
+BULK_DRAFT_WORKERS = max(1, int(st.secrets.get("BULK_DRAFT_WORKERS", 4)))
+BULK_DRAFT_RPM = max(1.0, float(st.secrets.get("BULK_DRAFT_RPM", 20)))
+# 同じ入力のドラフト生成結果を再利用する秒数（0ならキャッシュしない）
+DRAFT_CACHE_TTL = float(st.secrets.get("DRAFT_CACHE_TTL", 3600))
+DRAFT_CACHE_MAX_ENTRIES = 256
+# ドラフト生成のプロンプトに入れる可変部分（メモ・過去の連絡帳・修正例・文体見本）のトークン数の上限
+DRAFT_CONTEXT_TOKEN_BUDGET = int(st.secrets.get("DRAFT_CONTEXT_TOKEN_BUDGET", 8000))
+# 残りがこれより少なければ、短縮せずに省略する
+DRAFT_MIN_SECTION_TOKENS = 100
+# 要約されていないメモがこの件数たまったら、バックグラウンドで当日の要約に畳み込む（0なら要約しない）
+MEMO_SUMMARY_BATCH = int(st.secrets.get("MEMO_SUMMARY_BATCH", 5))
+MEMO_SUMMARY_MODEL = st.secrets.get("MEMO_SUMMARY_MODEL", "claude-haiku-4-5-20251001")
+# 先読みモード: メモが一定時間増えていない児童や、Tab 2で開いた児童のドラフトをバックグラウンドで作っておく
+SPECULATIVE_DRAFTS = bool(st.secrets.get("SPECULATIVE_DRAFTS", False))
+SPECULATIVE_STABLE_MINUTES = float(st.secrets.get("SPECULATIVE_STABLE_MINUTES", 10))
+# 過去の連絡帳を、最新順ではなく当日のメモとの関連度（BM25）順に選ぶ
+PAST_REPORT_RETRIEVAL = bool(st.secrets.get("PAST_REPORT_RETRIEVAL", True))
+# 同じ児童の当日のメモとの推定重複率がこれ以上なら、ほぼ同じメモとみなす（1以上なら判定しない）
+MEMO_DUP_THRESHOLD = float(st.secrets.get("MEMO_DUP_THRESHOLD", 0.8))
+# 月別アーカイブ: Sheet1 から移した先月以前の行は Sheet1_YYYY-MM シートに置き、archive_manifest シートに一覧を持つ
+ARCHIVE_SHEET_PREFIX = "Sheet1_"
+ARCHIVE_MANIFEST_SHEET = "archive_manifest"
+# 過去の連絡帳・修正例を探すときに読むアーカイブの月数
+ARCHIVE_LOOKBACK_MONTHS = int(st.secrets.get("ARCHIVE_LOOKBACK_MONTHS", 12))
+# Sheet1 / member のローカルSQLiteミラーのパス（空なら使わない）
+LOCAL_DB_PATH = st.secrets.get("LOCAL_DB_PATH", "")
+
 # ---------------------------------------------------------
 # 2. データ操作
 # ---------------------------------------------------------
 
-def get_lists_and_profile(target_staff_name=None):
-    try:
-        service = get_gsp_service()
-        sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range="member!A:C").execute()
-        values = sheet.get('values', [])
+class LocalMirror:
+    """
+    Sheet1 と member のローカルSQLiteミラー（LOCAL_DB_PATH 設定時のみ）
+    - 起動直後はミラーからスナップショットを復元し、Sheetsからは末尾同期だけ行う
+    - Sheetsに繋がらない（障害・429）間もミラー由来のスナップショットで読み取りを続けられる
+    - 書き込みキューの送信待ち行を outbox テーブルに保存する
+    - バックグラウンドで定期的に全件同期し、スプレッドシート上で直接編集された内容を取り込む
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS log (
+            row_no INTEGER PRIMARY KEY, date TEXT,
+            ts TEXT, child TEXT, text TEXT, type TEXT, staff TEXT, hint TEXT, ai_draft TEXT, tag TEXT, score TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_log_child_date_type ON log (child, date, type);
+        CREATE INDEX IF NOT EXISTS idx_log_staff_type ON log (staff, type);
+        CREATE INDEX IF NOT EXISTS idx_log_date ON log (date);
+        CREATE TABLE IF NOT EXISTS member (
+            row_no INTEGER PRIMARY KEY, child TEXT, staff TEXT, profile TEXT, prompt TEXT, prompt_internal TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_member_staff ON member (staff);
+        CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, row TEXT);
+    """
+    LOG_COLS = 9
+    MEMBER_COLS = 5
+
+    def __init__(self, path, pull_interval):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(self.SCHEMA)
+        self.pull_interval = pull_interval
+        threading.Thread(target=self._run_pull, name="local-mirror-pull", daemon=True).start()
+
+    @staticmethod
+    def _pad(row, width):
+        return (list(row) + [""] * width)[:width]
+
+    def load_log(self):
+        """Sheet1 の行を行番号順に返す（欠番は空行で埋める）"""
+        with self.lock:
+            records = self.conn.execute("SELECT row_no, ts, child, text, type, staff, hint, ai_draft, tag, score FROM log ORDER BY row_no").fetchall()
+        rows = []
+        for record in records:
+            while len(rows) < record[0] - 1:
+                rows.append([])
+            rows.append(_trim_row(["" if v is None else v for v in record[1:]]))
+        return rows
+
+    def save_log(self, first_row_no, rows, replace_all=False):
+        """Sheet1 の first_row_no 行目からの行を書き込む（replace_all なら全件入れ替え）"""
+        records = []
+        for i, row in enumerate(rows):
+            if row:
+                padded = self._pad(row, self.LOG_COLS)
+                records.append([first_row_no + i, padded[0][:10]] + padded)
+        with self.lock, self.conn:
+            if replace_all:
+                self.conn.execute("DELETE FROM log")
+            self.conn.executemany("INSERT OR REPLACE INTO log VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", records)
+
+    def load_members(self):
+        with self.lock:
+            records = self.conn.execute("SELECT row_no, child, staff, profile, prompt, prompt_internal FROM member ORDER BY row_no").fetchall()
+        values = []
+        for record in records:
+            while len(values) < record[0] - 1:
+                values.append([])
+            values.append(_trim_row(["" if v is None else v for v in record[1:]]))
+        return values
+
+    def save_members(self, values):
+        records = [[i + 1] + self._pad(row, self.MEMBER_COLS) for i, row in enumerate(values) if row]
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM member")
+            self.conn.executemany("INSERT INTO member VALUES (?, ?, ?, ?, ?, ?)", records)
+
+    def save_member_cell(self, row_no, col, value):
+        column = ("child", "staff", "profile", "prompt", "prompt_internal")[col]
+        with self.lock, self.conn:
+            self.conn.execute(f"UPDATE member SET {column} = ? WHERE row_no = ?", (value, row_no))
+
+    def _run_pull(self):
+        """全件同期を読み取りリクエストの外で定期的に行う"""
+        while True:
+            time.sleep(self.pull_interval)
+            try:
+                get_sheet_log().sync_now(full=True)
+                get_staff_directory().sync_now()
+            except Exception as e:
+                logger.warning("local mirror pull failed: %s", e)
+
+class SqliteOutbox:
+    """書き込みキューの送信待ち行を LocalMirror の outbox テーブルに保存する"""
+    def __init__(self, mirror):
+        self.mirror = mirror
+
+    def load(self):
+        with self.mirror.lock:
+            return [json.loads(r[0]) for r in self.mirror.conn.execute("SELECT row FROM outbox ORDER BY id")]
+
+    def add(self, row):
+        with self.mirror.lock, self.mirror.conn:
+            self.mirror.conn.execute("INSERT INTO outbox (row) VALUES (?)", (json.dumps(row, ensure_ascii=False),))
+
+    def replace(self, rows):
+        with self.mirror.lock, self.mirror.conn:
+            self.mirror.conn.execute("DELETE FROM outbox")
+            self.mirror.conn.executemany("INSERT INTO outbox (row) VALUES (?)", [(json.dumps(row, ensure_ascii=False),) for row in rows])
+
+class JsonlSpool:
+    """書き込みキューの送信待ち行を JSONL ファイルに保存する（ミラー未使用時）"""
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def add(self, row):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    def replace(self, rows):
+        with open(self.path, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+@st.cache_resource
+def get_local_mirror():
+    if not LOCAL_DB_PATH:
+        return None
+    # 読み取り時の全件同期より少し早く回し、読み取り側がフル同期を待たずに済むようにする
+    return LocalMirror(LOCAL_DB_PATH, SHEET_FULL_SYNC_INTERVAL * 0.9)
+
+# member シートの列（0始まり）
+MEMBER_PROFILE_COL = 2          # C列: 文体見本
+MEMBER_GUARDIAN_PROMPT_COL = 3  # D列: 保護者用カスタムプロンプト
+MEMBER_INTERNAL_PROMPT_COL = 4  # E列: 職員用カスタムプロンプト
+
+class StaffDirectory:
+    """
+    member!A:E を1回の読み込みで保持し、児童・職員の一覧と職員ごとの設定を名前で引けるようにする
+    """
+    def __init__(self, ttl, mirror=None):
+        self.ttl = ttl
+        self.mirror = mirror
+        self.children = []
+        self.staffs = []
+        self.staff_rows = {}  # 職員名 -> member シートの行（最初に現れた行）
+        self.row_numbers = {}  # 職員名 -> member シートの行番号（1始まり）
+        self.loaded_at = None
+        self.lock = threading.RLock()
+
+    def is_stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl
+
+    def _ensure_fresh(self):
+        if self.is_stale():
+            try:
+                self.sync_now()
+            except Exception as e:
+                if self.loaded_at is None:
+                    raise
+                # Sheetsに繋がらない間は手元の内容で応答し、TTL後に再試行する
+                logger.warning("member sync failed, serving cached directory: %s", e)
+                self.loaded_at = time.monotonic()
+
+    def sync_now(self):
+        with self.lock:
+            service = get_gsp_service()
+            sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range="member!A:E").execute()
+            self.load(sheet.get('values', []))
+
+    def load_from_mirror(self):
+        """ローカルミラーの内容で起動し、最初の参照時にSheetsと同期させる"""
+        values = self.mirror.load_members()
+        if values:
+            with self.lock:
+                self.load(values, from_mirror=True)
+                self.loaded_at = -float("inf")
+
+    def load(self, values, from_mirror=False):
+        """member!A:E の取得結果を取り込む（呼び出し側でロックを持つこと）"""
+        if self.mirror and not from_mirror:
+            self.mirror.save_members(values)
         children = [row[0] for row in values if len(row) > 0 and row[0]]
         staffs = []
-        for row in values:
-            if len(row) > 1 and row[1] and row[1] not in staffs:
+        staff_rows = {}
+        row_numbers = {}
+        for i, row in enumerate(values):
+            if len(row) > 1 and row[1] and row[1] not in staff_rows:
                 staffs.append(row[1])
+                staff_rows[row[1]] = list(row)
+                row_numbers[row[1]] = i + 1
+        self.children, self.staffs, self.staff_rows, self.row_numbers = children, staffs, staff_rows, row_numbers
+        self.loaded_at = time.monotonic()
+
+    def get_children(self):
+        with self.lock:
+            self._ensure_fresh()
+            return list(self.children)
+
+    def get_staffs(self):
+        with self.lock:
+            self._ensure_fresh()
+            return list(self.staffs)
+
+    def get_field(self, staff_name, col):
+        """職員の設定列の値を返す（未登録・未設定なら空文字）"""
+        with self.lock:
+            self._ensure_fresh()
+            row = self.staff_rows.get(staff_name)
+            if row is not None and len(row) > col:
+                return row[col]
+            return ""
+
+    def get_row_number(self, staff_name):
+        """
+        職員の行番号と、キャッシュが検証不要なほど新しいかを返す
+        戻り値: (行番号 または None, is_recent)
+        """
+        with self.lock:
+            self._ensure_fresh()
+            is_recent = time.monotonic() - self.loaded_at <= STAFF_VERIFY_AFTER
+            return self.row_numbers.get(staff_name), is_recent
+
+    def set_field(self, staff_name, col, value):
+        """保存済みの値をキャッシュにも反映する"""
+        with self.lock:
+            row = self.staff_rows.get(staff_name)
+            if row is None:
+                return
+            while len(row) <= col:
+                row.append("")
+            row[col] = value
+            if self.mirror:
+                self.mirror.save_member_cell(self.row_numbers[staff_name], col, value)
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+@st.cache_resource
+def get_staff_directory():
+    directory = StaffDirectory(STAFF_CACHE_TTL, get_local_mirror())
+    if directory.mirror:
+        directory.load_from_mirror()
+    return directory
+
+def get_lists_and_profile(target_staff_name=None):
+    try:
+        directory = get_staff_directory()
+        children = directory.get_children()
+        staffs = directory.get_staffs()
         current_profile = ""
         if target_staff_name:
-            for row in values:
-                if len(row) > 1 and row[1] == target_staff_name:
-                    if len(row) > 2: current_profile = row[2]
-                    break
+            current_profile = directory.get_field(target_staff_name, MEMBER_PROFILE_COL)
         return children, staffs, current_profile
     except Exception as e:
         st.error(f"データ取得エラー: {str(e)}")
         return [], [], ""
 
-def save_staff_profile(staff_name, profile_text):
-    try:
-        service = get_gsp_service()
-        sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range="member!A:C").execute()
-        values = sheet.get('values', [])
-        update_index = -1
-        for i, row in enumerate(values):
-            if len(row) > 1 and row[1] == staff_name:
-                update_index = i; break
-        if update_index != -1:
-            body = {'values': [[profile_text]]}
-            service.spreadsheets().values().update(spreadsheetId=SPREADSHEET_ID, range=f"member!C{update_index + 1}", valueInputOption="USER_ENTERED", body=body).execute()
-            return True
-        return False
-    except Exception as e:
-        st.error(f"プロファイル保存エラー: {str(e)}")
+def _resolve_staff_row(staff_name):
+    """
+    職員の member シート行番号をキャッシュから求める（シート全体は読み直さない）
+    キャッシュが古ければB列の1セルだけ読んで職員名を確認し、ずれていればキャッシュを取り直す
+    """
+    directory = get_staff_directory()
+    row_number, is_recent = directory.get_row_number(staff_name)
+    if row_number is None or is_recent:
+        return row_number
+    service = get_gsp_service()
+    sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range=f"member!B{row_number}").execute()
+    values = sheet.get('values', [])
+    if values and values[0] and values[0][0] == staff_name:
+        return row_number
+    # 行の挿入・削除などでずれている
+    directory.invalidate()
+    return directory.get_row_number(staff_name)[0]
+
+def _write_staff_fields(staff_name, fields):
+    """
+    職員の設定列（{列番号: 値}）を1回の values().batchUpdate でまとめて書き込む
+    戻り値: 職員が見つかって書き込めたら True
+    """
+    row_number = _resolve_staff_row(staff_name)
+    if row_number is None:
         return False
+    data = [{'range': f"member!{'ABCDE'[col]}{row_number}", 'values': [[value]]} for col, value in fields.items()]
+    service = get_gsp_service()
+    service.spreadsheets().values().batchUpdate(spreadsheetId=SPREADSHEET_ID, body={'valueInputOption': "USER_ENTERED", 'data': data}).execute()
+    directory = get_staff_directory()
+    for col, value in fields.items():
+        directory.set_field(staff_name, col, value)
+    return True
+
+def _write_staff_fields_in_background(staff_name, fields):
+    """submit_save から呼ぶ _write_staff_fields。失敗したら楽観的に反映した値を捨てさせるため member を読み直させる"""
+    try:
+        written = _write_staff_fields(staff_name, fields)
+    except Exception:
+        get_staff_directory().invalidate()
+        raise
+    if not written:
+        get_staff_directory().invalidate()
+    return written
+
+def _save_staff_fields(staff_name, fields, label):
+    """職員の設定をキャッシュに先に反映し、Sheetsへの書き込みは待たずにバックグラウンドで行う"""
+    directory = get_staff_directory()
+    for col, value in fields.items():
+        directory.set_field(staff_name, col, value)
+    submit_save(label, _write_staff_fields_in_background, staff_name, fields)
+    return True
+
+def save_staff_settings(staff_name, profile_text=None, custom_prompt=None, custom_prompt_internal=None):
+    """文体見本・保護者用・職員用プロンプトのうち指定されたものを1リクエストで保存"""
+    fields = {}
+    if profile_text is not None: fields[MEMBER_PROFILE_COL] = profile_text
+    if custom_prompt is not None: fields[MEMBER_GUARDIAN_PROMPT_COL] = custom_prompt
+    if custom_prompt_internal is not None: fields[MEMBER_INTERNAL_PROMPT_COL] = custom_prompt_internal
+    if not fields:
+        return True
+    return _save_staff_fields(staff_name, fields, "設定保存")
+
+def save_staff_profile(staff_name, profile_text):
+    return _save_staff_fields(staff_name, {MEMBER_PROFILE_COL: profile_text}, "プロファイル保存")
 
 def get_staff_custom_prompt(staff_name):
     """スタッフのカスタムプロンプトを取得"""
     try:
-        service = get_gsp_service()
-        sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range="member!A:D").execute()
-        values = sheet.get('values', [])
-        for row in values:
-            if len(row) > 1 and row[1] == staff_name:
-                if len(row) > 3:
-                    return row[3]  # D列のカスタムプロンプト
-                break
-        return ""
+        return get_staff_directory().get_field(staff_name, MEMBER_GUARDIAN_PROMPT_COL)  # D列のカスタムプロンプト
     except Exception as e:
         st.error(f"カスタムプロンプト取得エラー: {str(e)}")
         return ""
 
 def save_staff_custom_prompt(staff_name, custom_prompt):
     """スタッフのカスタムプロンプト（保護者用）を保存"""
-    try:
-        service = get_gsp_service()
-        sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range="member!A:D").execute()
-        values = sheet.get('values', [])
-        update_index = -1
-        for i, row in enumerate(values):
-            if len(row) > 1 and row[1] == staff_name:
-                update_index = i; break
-        if update_index != -1:
-            body = {'values': [[custom_prompt]]}
-            service.spreadsheets().values().update(spreadsheetId=SPREADSHEET_ID, range=f"member!D{update_index + 1}", valueInputOption="USER_ENTERED", body=body).execute()
-            return True
-        return False
-    except Exception as e:
-        st.error(f"カスタムプロンプト保存エラー: {str(e)}")
-        return False
+    return _save_staff_fields(staff_name, {MEMBER_GUARDIAN_PROMPT_COL: custom_prompt}, "カスタムプロンプト保存")
 
 def get_staff_custom_prompt_internal(staff_name):
     """スタッフの内部用カスタムプロンプト（職員用）を取得"""
     try:
-        service = get_gsp_service()
-        sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range="member!A:E").execute()
-        values = sheet.get('values', [])
-        for row in values:
-            if len(row) > 1 and row[1] == staff_name:
-                if len(row) > 4:
-                    return row[4]  # E列の内部用カスタムプロンプト
-                break
-        return ""
+        return get_staff_directory().get_field(staff_name, MEMBER_INTERNAL_PROMPT_COL)  # E列の内部用カスタムプロンプト
     except Exception as e:
         st.error(f"内部用カスタムプロンプト取得エラー: {str(e)}")
         return ""
 
 def save_staff_custom_prompt_internal(staff_name, custom_prompt_internal):
     """スタッフの内部用カスタムプロンプト（職員用）を保存"""
-    try:
-        service = get_gsp_service()
-        sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range="member!A:E").execute()
-        values = sheet.get('values', [])
-        update_index = -1
-        for i, row in enumerate(values):
-            if len(row) > 1 and row[1] == staff_name:
-                update_index = i; break
-        if update_index != -1:
-            body = {'values': [[custom_prompt_internal]]}
-            service.spreadsheets().values().update(spreadsheetId=SPREADSHEET_ID, range=f"member!E{update_index + 1}", valueInputOption="USER_ENTERED", body=body).execute()
-            return True
-        return False
-    except Exception as e:
-        st.error(f"内部用カスタムプロンプト保存エラー: {str(e)}")
-        return False
+    return _save_staff_fields(staff_name, {MEMBER_INTERNAL_PROMPT_COL: custom_prompt_internal}, "内部用カスタムプロンプト保存")
 
 def get_high_diff_examples(staff_name, limit=3):
     try:
-        service = get_gsp_service()
-        sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range="Sheet1!A:H").execute()
-        rows = sheet.get('values', [])
-        candidates = []
-        for row in rows:
-            if len(row) >= 7 and row[4] == staff_name and row[3] == "REPORT":
-                similarity = difflib.SequenceMatcher(None, row[6], row[2]).ratio()
-                if (1.0 - similarity) > 0.05:
-                    candidates.append({"text": row[2], "diff": 1.0 - similarity})
-        candidates.sort(key=lambda x: x["diff"], reverse=True)
-        return [item["text"] for item in candidates[:limit]]
+        # save_final_report 時に計算済みのI列スコアから、パーティションごとの職員別上位ヒープを引いて合わせるだけ
+        ranked = heapq.nlargest(limit, (pair for sheet_log in log_partitions() for pair in sheet_log.top_diff_reports(staff_name, limit)),
+                                key=operator.itemgetter(0))
+        return [row[2] for score, row in ranked if score > 0.05]
     except Exception as e:
         st.error(f"例文取得エラー: {str(e)}")
         return []
 
-def save_memo(child_name, text, staff_name, is_highlight=False):
+def _diff_score(ai_draft, final_text):
+    """AIドラフトから確定版への修正量（1 - 類似度）"""
+    return 1.0 - difflib.SequenceMatcher(None, ai_draft, final_text).ratio()
+
+def _ngram_diff_score(ai_draft, final_text, n=2):
+    """文字n-gramの多重集合のDice係数による修正量の近似（長文向け・線形時間）"""
+    a = Counter(ai_draft[i:i + n] for i in range(len(ai_draft) - n + 1))
+    b = Counter(final_text[i:i + n] for i in range(len(final_text) - n + 1))
+    total = sum(a.values()) + sum(b.values())
+    if not total:
+        return 0.0 if ai_draft == final_text else 1.0
+    return 1.0 - 2.0 * sum((a & b).values()) / total
+
+@st.cache_resource
+def get_diff_pool():
+    return ProcessPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+
+def _exact_ratios(pairs):
+    """SequenceMatcher.ratio() をまとめて計算する（件数が多ければプロセスプールで並列化）"""
+    matchers = [difflib.SequenceMatcher(None, a, b) for a, b in pairs]
+    if len(matchers) >= DIFF_POOL_MIN_PAIRS:
+        try:
+            # Streamlitのスクリプトは import できないため、関数ではなくマッチャー自体を送って ratio を呼ばせる
+            chunksize = max(1, len(matchers) // (4 * (os.cpu_count() or 1)))
+            return list(get_diff_pool().map(operator.methodcaller("ratio"), matchers, chunksize=chunksize))
+        except Exception:
+            # プールが使えない環境・壊れたプールは作り直し、今回は直列で計算する
+            get_diff_pool.clear()
+    return [m.ratio() for m in matchers]
+
+def score_diff_pairs(pairs, mode="exact"):
+    """
+    [(AIドラフト, 確定本文)] の修正量をまとめて計算する
+    mode: "exact"（_diff_score と同じ値）/ "ngram"（文字bigramによる近似）
+    DIFF_NGRAM_MIN_CHARS 以上の長文は exact 指定でも近似で計算する
+    """
+    scores = [None] * len(pairs)
+    exact = []
+    for i, (a, b) in enumerate(pairs):
+        if a == b:
+            scores[i] = 0.0
+        elif mode == "ngram" or (DIFF_NGRAM_MIN_CHARS and max(len(a), len(b)) >= DIFF_NGRAM_MIN_CHARS):
+            scores[i] = _ngram_diff_score(a, b)
+        else:
+            exact.append(i)
+    for i, ratio in zip(exact, _exact_ratios([pairs[i] for i in exact])):
+        scores[i] = 1.0 - ratio
+    return scores
+
+def _diff_score_upper_bound(ai_draft, final_text):
+    """
+    _diff_score の上界（実際の修正量がこれを超えることはない）
+    共通の先頭・末尾はそれぞれ一致ブロックになりうるので、一致文字数は少なくともその長い方以上になる。
+    確定本文が200文字以上だと difflib の autojunk で頻出文字が一致に使われず成り立たないので 1.0 を返す
+    """
+    if len(final_text) >= 200:
+        return 1.0
+    prefix = len(os.path.commonprefix([ai_draft, final_text]))
+    suffix = len(os.path.commonprefix([ai_draft[::-1], final_text[::-1]]))
+    return 1.0 - 2.0 * max(prefix, suffix) / (len(ai_draft) + len(final_text))
+
+def top_diff_pairs(pairs, limit, mode=None, floor=None):
+    """
+    修正量の上位limit件に入りうるペアだけを採点して [(添字, スコア)] を返す
+    - 同一文字列（修正量0）は採点しない
+    - "exact" では上界（_diff_score_upper_bound）の大きい順に採点し、上界が採点済みの limit 番目のスコアを
+      下回ったところで打ち切る。上位limit件は全件を採点した場合と同じになる
+    - "prefilter" は近似: bigram 近似で上位 limit*DIFF_PREFILTER_FACTOR 件に絞ってから厳密に採点するので、
+      近似が修正量を小さく見積もったペアは上位に入るはずでも落ちることがある
+    - "ngram" は全件を bigram 近似で採点する
+    floor（すでに分かっている上位limit件の最下位スコア）を渡すと、"exact" では上界がそれを下回るペアも採点しない
+    """
+    mode = mode or DIFF_SCORING_MODE
+    indices = [i for i, (a, b) in enumerate(pairs) if a != b]
+    if mode == "ngram":
+        return list(zip(indices, score_diff_pairs([pairs[i] for i in indices], mode="ngram")))
+    if mode == "prefilter":
+        keep = limit * DIFF_PREFILTER_FACTOR
+        if len(indices) > keep:
+            estimates = {i: _ngram_diff_score(*pairs[i]) for i in indices}
+            indices = sorted(sorted(indices, key=lambda i: (-estimates[i], i))[:keep])
+        return list(zip(indices, score_diff_pairs([pairs[i] for i in indices])))
+    # DIFF_NGRAM_MIN_CHARS 以上の長文は近似で採点されるので、difflib の上界では打ち切らない
+    bounds = {i: 1.0 if DIFF_NGRAM_MIN_CHARS and max(map(len, pairs[i])) >= DIFF_NGRAM_MIN_CHARS
+              else _diff_score_upper_bound(*pairs[i]) for i in indices}
+    ordered = sorted((i for i in indices if floor is None or bounds[i] >= floor), key=lambda i: (-bounds[i], i))
+    scored = []
+    top = []  # 採点済みスコアの上位limit件（最小ヒープ）
+    batch_size = max(limit, DIFF_POOL_MIN_PAIRS)  # プロセスプールを使える単位でまとめて採点する
+    for start in range(0, len(ordered), batch_size):
+        batch = [i for i in ordered[start:start + batch_size] if len(top) < limit or bounds[i] >= top[0]]
+        if not batch:
+            break  # 上界の大きい順なので、残りはどれも上位limit件に入らない
+        for i, score in zip(batch, score_diff_pairs([pairs[i] for i in batch])):
+            scored.append((i, score))
+            if len(top) < limit:
+                heapq.heappush(top, score)
+            elif score > top[0]:
+                heapq.heapreplace(top, score)
+    return sorted(scored)
+
+def _format_diff_score(score):
+    return f"{score:.6f}"
+
+def _is_scorable_report(row):
+    """修正量を計算できるREPORT行か（AIドラフトと確定本文が両方ある）"""
+    return len(row) >= 7 and row[3] == "REPORT" and bool(row[6]) and bool(row[2])
+
+def _parse_diff_score(row):
+    """I列の修正量スコアを返す（未記入・解釈不能なら None）"""
+    if len(row) > LOG_DIFF_SCORE_COL and row[LOG_DIFF_SCORE_COL] != "":
+        try:
+            return float(row[LOG_DIFF_SCORE_COL])
+        except ValueError:
+            return None
+    return None
+
+def write_diff_scores(sheet_log, scored):
+    """修正量スコアをI列に1回の values().batchUpdate で書き込み、スナップショットにも反映する。scored: [(位置, 行, スコア文字列)]"""
+    # rows の位置 = シートの行番号 - 1
+    data = [{'range': f"{sheet_log.sheet}!I{pos + 1}", 'values': [[score]]} for pos, row, score in scored]
+    service = get_gsp_service()
+    service.spreadsheets().values().batchUpdate(spreadsheetId=SPREADSHEET_ID, body={'valueInputOption': "RAW", 'data': data}).execute()
+    for pos, row, score in scored:
+        sheet_log.set_diff_score(pos, row, score)
+
+def backfill_diff_scores(batch_size=500):
+    """
+    過去のREPORT行のうちI列（修正量スコア）が空のものを計算して書き込む（一回限りの移行用）
+    戻り値: 書き込んだ行数
+    """
+    written = 0
+    # 今月分（Sheet1）と、参照対象の月別アーカイブの両方を埋める
+    for sheet_log in log_partitions():
+        targets = sheet_log.unscored_reports()
+        for start in range(0, len(targets), batch_size):
+            batch = targets[start:start + batch_size]
+            scores = score_diff_pairs([(row[6], row[2]) for pos, row in batch])
+            chunk = [(pos, row, _format_diff_score(score)) for (pos, row), score in zip(batch, scores)]
+            write_diff_scores(sheet_log, chunk)
+            written += len(chunk)
+    return written
+
+def _char_bigrams(text):
+    """空白を除いた文字bigramの出現数（分かち書きなしで日本語を検索するための語）"""
+    text = re.sub(r"\s+", "", text)
+    return Counter(text[i:i + 2] for i in range(len(text) - 1))
+
+class ReportIndex:
+    """1人の児童の確定済み連絡帳に対する文字bigramのBM25索引（追記のみ）"""
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self):
+        self.positions = []  # 文書番号 -> SheetLog.rows 内の位置
+        self.lengths = []    # 文書番号 -> 語数
+        self.postings = {}   # 語 -> [(文書番号, 出現数)]
+        self.total_length = 0
+
+    def add(self, pos, text):
+        doc = len(self.positions)
+        terms = _char_bigrams(text)
+        self.positions.append(pos)
+        self.lengths.append(sum(terms.values()))
+        self.total_length += self.lengths[-1]
+        for term, count in terms.items():
+            self.postings.setdefault(term, []).append((doc, count))
+
+    def stats(self, terms):
+        """BM25の統計（文書数, 総語数, 語 -> 文書頻度）。複数の索引をまとめて1つのコーパスとして採点するのに使う"""
+        return len(self.positions), self.total_length, {term: len(self.postings[term]) for term in terms if term in self.postings}
+
+    def search(self, query, limit, exclude=None, corpus=None):
+        """
+        query との関連度の高い順に最大limit件返す（同点なら新しい方を優先）: [(スコア, 位置)]
+        corpus（文書数, 平均語数, 語 -> 文書頻度）を渡すと、この索引単体ではなくそのコーパスの idf と平均語数で採点する
+        """
+        if not self.positions:
+            return []
+        terms = _char_bigrams(query)
+        n_docs, avg_length, doc_freq = corpus or (len(self.positions), self.total_length / len(self.positions) or 1, None)
+        scores = {}
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            df = doc_freq.get(term, len(postings)) if doc_freq is not None else len(postings)
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            for doc, count in postings:
+                norm = count + self.K1 * (1 - self.B + self.B * self.lengths[doc] / avg_length)
+                scores[doc] = scores.get(doc, 0.0) + idf * count * (self.K1 + 1) / norm
+        ranked = heapq.nlargest(len(scores), scores, key=lambda doc: (scores[doc], doc))
+        result = []
+        for doc in ranked:
+            if exclude and exclude(self.positions[doc]):
+                continue
+            result.append((scores[doc], self.positions[doc]))
+            if len(result) >= limit:
+                break
+        return result
+
+def merge_report_stats(stats):
+    """ReportIndex.stats の結果を足し合わせ、ReportIndex.search に渡す corpus（文書数, 平均語数, 語 -> 文書頻度）にする"""
+    n_docs = sum(n for n, total, doc_freq in stats)
+    total_length = sum(total for n, total, doc_freq in stats)
+    merged = Counter()
+    for n, total, doc_freq in stats:
+        merged.update(doc_freq)
+    return n_docs, (total_length / n_docs if n_docs else 0) or 1, dict(merged)
+
+def _trim_row(row):
+    """Sheets APIの返り値と揃えるため、末尾の空セルを落とす"""
+    row = list(row)
+    while row and row[-1] == "":
+        row.pop()
+    return row
+
+class SheetLog:
+    """
+    Sheet1!A:I のプロセス共通スナップショット
+    Sheet1は追記専用のログなので、取り込み済みの行数を覚えておき、
+    更新時は末尾（A{n+1}:I）だけを取得してマージする。自分の追記は updatedRange から反映する。
+    sheet にアーカイブシート名を渡すと、その月のパーティションを読む（LogArchive が使う）
+    """
+    def __init__(self, ttl, full_sync_interval, mirror=None, sheet="Sheet1"):
+        self.sheet = sheet
+        self.ttl = ttl
+        self.full_sync_interval = full_sync_interval
+        self.mirror = mirror
+        self.rows = []
+        self.synced_rows = 0  # 取り込み済みのシート行数（= 最終取り込み行の行番号）
+        # rows 内の位置のインデックス（追記順＝時系列順に並ぶ）
+        self.by_key = {}            # (児童名, 日付, 種別) -> [位置]
+        self.reports_by_child = {}  # 児童名 -> [REPORTの位置]
+        self.report_indexes = {}    # 児童名 -> 本文のある REPORT の ReportIndex
+        # 職員ごとの修正量（I列）上位 DIFF_TOP_K 件のヒープ [(スコア, -位置)]
+        self.top_diffs = {}
+        self.unscored_by_staff = {}  # 職員名 -> [I列が未計算のREPORTの位置]（参照時に計算）
+        self.pending = []  # 書き込みキューで送信待ちの行（読み取りには即時反映する）
+        self.appended_through = 0  # 自分が追記した最後の行番号のうち、まだ取り込んでいないもの（末尾同期で届くはずの行）
+        self.loaded_at = None
+        self.full_synced_at = None
+        self.lock = threading.RLock()
+
+    def is_stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl
+
+    def refresh(self):
+        """末尾の新しい行だけを取り込む。初回と定期フル同期（手動編集の反映）のみ全件取得"""
+        with self.lock:
+            sync_range, is_full = self.sync_range()
+            service = get_gsp_service()
+            sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range=sync_range).execute()
+            self.apply_sync(sheet.get('values', []), is_full)
+            if self.loaded_at is None:
+                # 末尾同期が自分の追記した行まで届かなかった（シートが縮んだ）ので、その場で全件取り直す
+                self.refresh()
+
+    def sync_range(self):
+        """次の同期で取得する範囲と、それが全件取得かどうか"""
+        if self.full_synced_at is None or time.monotonic() - self.full_synced_at > self.full_sync_interval:
+            return f"{self.sheet}!A:I", True
+        return f"{self.sheet}!A{self.synced_rows + 1}:I", False
+
+    def sync_now(self, full=False):
+        """TTLに関係なく今すぐ同期する（full なら全件取得）"""
+        with self.lock:
+            if full:
+                self.full_synced_at = None
+            self.refresh()
+
+    def load_from_mirror(self):
+        """ローカルミラーの内容で起動する。以降は末尾同期のみ（全件同期はミラーの定期同期に任せる）"""
+        rows = self.mirror.load_log()
+        if rows:
+            with self.lock:
+                self.apply_sync(rows, True, from_mirror=True)
+                self.loaded_at = -float("inf")
+
+    def apply_sync(self, values, is_full, from_mirror=False):
+        """sync_range() の範囲を取得した結果を取り込む（呼び出し側でロックを持つこと）"""
+        now = time.monotonic()
+        if self.mirror and not from_mirror:
+            self.mirror.save_log(1 if is_full else self.synced_rows + 1, values, replace_all=is_full)
+        if is_full:
+            self.rows = []
+            self.by_key, self.reports_by_child = {}, {}
+            self.report_indexes = {}
+            self.top_diffs, self.unscored_by_staff = {}, {}
+            self.synced_rows = 0
+            self.full_synced_at = now
+        self._ingest(values)
+        self.synced_rows += len(values)
+        self.loaded_at = now
+        if is_full:
+            self.appended_through = 0
+        elif self.synced_rows < self.appended_through:
+            # 自分の追記が末尾同期で見つからない: 手前の行が削除されたので、次の読み込みで全件取り直す
+            self.invalidate()
+
+    def _ingest(self, rows):
+        """行を末尾に追加し、インデックスを更新する"""
+        for row in rows:
+            pos = len(self.rows)
+            self.rows.append(row)
+            if len(row) < 4:
+                continue
+            self.by_key.setdefault((row[1], row[0][:10], row[3]), []).append(pos)
+            if row[3] == "REPORT":
+                self.reports_by_child.setdefault(row[1], []).append(pos)
+                if row[2] and len(row[2].strip()) > 10:
+                    self.report_indexes.setdefault(row[1], ReportIndex()).add(pos, row[2])
+                if _is_scorable_report(row):
+                    score = _parse_diff_score(row)
+                    if score is None:
+                        self.unscored_by_staff.setdefault(row[4], []).append(pos)
+                    else:
+                        self._push_diff(row[4], score, pos)
+
+    def _push_diff(self, staff_name, score, pos):
+        heap = self.top_diffs.setdefault(staff_name, [])
+        entry = (score, -pos)  # 同点なら古い行を優先（従来の安定ソートと同じ順）
+        if len(heap) < DIFF_TOP_K:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    def top_diff_reports(self, staff_name, limit):
+        """職員のREPORTを修正量の大きい順に最大limit件（DIFF_TOP_K件まで）返す: [(スコア, 行)]"""
+        with self.lock:
+            self._ensure_fresh()
+            # I列が未計算の行（バックフィル前の過去分）は、上位に入りうるものだけをここで計算してI列に書き込む
+            pending = []
+            for pos in self.unscored_by_staff.pop(staff_name, []):
+                row = self.rows[pos]
+                score = _parse_diff_score(row)  # 取り込み後にバックフィルで書き込まれていればそれを使う
+                if score is None:
+                    pending.append((pos, row))
+                else:
+                    self._push_diff(staff_name, score, pos)
+            heap = self.top_diffs.get(staff_name, [])
+            floor = heap[0][0] if len(heap) >= DIFF_TOP_K else None
+        scored = []
+        if pending:
+            # 採点は重いので、ロックを離して他のセッションの読み取りを止めない
+            for i, score in top_diff_pairs([(row[6], row[2]) for pos, row in pending], DIFF_TOP_K, floor=floor):
+                pos, row = pending[i]
+                scored.append((pos, row, _format_diff_score(score)))
+        with self.lock:
+            # 採点中に全件同期されていれば、その行は取り込み直されて未計算に戻っている
+            scored = [(pos, row, score) for pos, row, score in scored if pos < len(self.rows) and self.rows[pos] is row]
+            for pos, row, score in scored:
+                self._push_diff(staff_name, float(score), pos)
+        if scored:
+            # 全件同期のたびに計算し直さないよう、I列にも書き込んでおく（失敗しても今回の結果はそのまま使う）
+            try:
+                write_diff_scores(self, scored)
+            except Exception as e:
+                logger.warning("writing lazy diff scores to %s failed: %s", self.sheet, e)
+        with self.lock:
+            ranked = sorted(self.top_diffs.get(staff_name, []), reverse=True)[:limit]
+            return [(score, self.rows[-neg_pos]) for score, neg_pos in ranked]
+
+    def unscored_reports(self):
+        """I列が未記入のREPORT行（バックフィル対象）: [(位置, 行)]"""
+        with self.lock:
+            self._ensure_fresh()
+            return [(pos, row) for pos, row in enumerate(self.rows) if _is_scorable_report(row) and _parse_diff_score(row) is None]
+
+    def set_diff_score(self, pos, row, score_str):
+        """書き込んだI列をスナップショットにも反映する（途中で全件同期されていれば何もしない）"""
+        with self.lock:
+            if pos >= len(self.rows) or self.rows[pos] is not row:
+                return
+            while len(row) <= LOG_DIFF_SCORE_COL:
+                row.append("")
+            row[LOG_DIFF_SCORE_COL] = score_str
+            if self.mirror:
+                self.mirror.save_log(pos + 1, [row])
+
+    def _ensure_fresh(self):
+        if self.is_stale():
+            try:
+                self.refresh()
+            except Exception as e:
+                if self.loaded_at is None:
+                    raise
+                # Sheetsに繋がらない間は手元のスナップショットで応答し、TTL後に再試行する
+                logger.warning("%s sync failed, serving cached log: %s", self.sheet, e)
+                self.loaded_at = time.monotonic()
+
+    def find(self, child_name, date_str, row_type):
+        """指定した児童・日付・種別の行を時系列順に返す"""
+        with self.lock:
+            self._ensure_fresh()
+            found = [self.rows[i] for i in self.by_key.get((child_name, date_str, row_type), [])]
+            found.extend(row for row in self.pending
+                         if len(row) >= 4 and row[1] == child_name and row[0][:10] == date_str and row[3] == row_type)
+            return found
+
+    def child_reports(self, child_name):
+        """児童のREPORT行を時系列順に返す"""
+        with self.lock:
+            self._ensure_fresh()
+            return [self.rows[i] for i in self.reports_by_child.get(child_name, [])]
+
+    def report_stats(self, child_name, query):
+        """児童の ReportIndex の、query の語についての統計（ReportIndex.stats）。索引がなければ None"""
+        with self.lock:
+            self._ensure_fresh()
+            index = self.report_indexes.get(child_name)
+            return index.stats(_char_bigrams(query)) if index is not None else None
+
+    def relevant_reports(self, child_name, query, limit, exclude_date=None, corpus=None):
+        """
+        児童の本文のあるREPORT行を query との関連度順に最大limit件返す（exclude_date の日付の行を除く）: [(スコア, 行)]
+        corpus は ReportIndex.search と同じ（複数パーティションのスコアを比べるときに渡す）
+        """
+        with self.lock:
+            self._ensure_fresh()
+            index = self.report_indexes.get(child_name)
+            if index is None:
+                return []
+            exclude = (lambda pos: self.rows[pos][0].startswith(exclude_date)) if exclude_date else None
+            return [(score, self.rows[pos]) for score, pos in index.search(query, limit, exclude, corpus)]
+
+    def add_rows(self, rows, updated_range):
+        """
+        自分で追記した行を反映する。updated_range（例: Sheet1!A124:I125）の開始行が
+        取り込み済みの次の行なら再取得なしでマージし、間に他者の追記があれば次回の末尾同期に任せる
+        """
+        start, end = _parse_row_span(updated_range)
+        with self.lock:
+            if self.loaded_at is None:
+                return
+            if start == self.synced_rows + 1 and end - start + 1 == len(rows):
+                self._ingest([_trim_row(row) for row in rows])
+                self.synced_rows = end
+                if self.mirror:
+                    self.mirror.save_log(start, rows)
+            elif start <= self.synced_rows:
+                # 取り込み済みの行数より手前に追記された: 手動削除やアーカイブでシートが縮んだので全件取り直す
+                self.invalidate()
+            else:
+                # 間に他者の追記がある。末尾同期で少なくとも自分の追記した行まで届くはず
+                self.appended_through = max(self.appended_through, end)
+                self.mark_stale()
+
+    def add_pending(self, row):
+        """書き込みキューに入った行を、送信前から読み取りに見せる"""
+        with self.lock:
+            self.pending.append(_trim_row(row))
+
+    def commit_pending(self, count, rows, updated_range):
+        """送信済みになった保留行（先頭から count 件）を、追記済みの行として取り込み直す"""
+        with self.lock:
+            del self.pending[:count]
+            self.add_rows(rows, updated_range)
+
+    def discard_pending(self, count):
+        """送信できずに書き込みキューから外した保留行（先頭から count 件）を読み取りから消す"""
+        with self.lock:
+            del self.pending[:count]
+
+    def mark_stale(self):
+        """次回の読み込みで末尾同期させる"""
+        with self.lock:
+            if self.loaded_at is not None:
+                self.loaded_at = -float("inf")
+
+    def invalidate(self):
+        """次回の読み込みで全件取り直させる"""
+        with self.lock:
+            self.loaded_at = None
+            self.full_synced_at = None
+
+def _parse_row_span(a1_range):
+    """'Sheet1!A124:H125' → (124, 125)。解釈できなければ (0, -1)"""
+    m = re.search(r"![A-Z]+(\d+)(?::[A-Z]+(\d+))?$", a1_range or "")
+    if not m:
+        return 0, -1
+    start = int(m.group(1))
+    return start, int(m.group(2) or start)
+
+@st.cache_resource
+def get_sheet_log():
+    sheet_log = SheetLog(SHEET_CACHE_TTL, SHEET_FULL_SYNC_INTERVAL, get_local_mirror())
+    if sheet_log.mirror:
+        sheet_log.load_from_mirror()
+    return sheet_log
+
+class LogArchive:
+    """
+    Sheet1 から移した月別アーカイブシート（一覧は archive_manifest シート）の読み取り
+    アーカイブは書き換わらないので、各月のシートは初めて必要になったときに1回だけ読み込む
+    """
+    def __init__(self, manifest_ttl, lookback_months):
+        self.manifest_ttl = manifest_ttl
+        self.lookback_months = lookback_months
+        self.entries = []  # [(月, シート名)] 古い順
+        self.partitions = {}  # シート名 -> SheetLog
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def refresh_manifest(self):
+        service = get_gsp_service()
+        try:
+            sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range=f"{ARCHIVE_MANIFEST_SHEET}!A:B").execute()
+        except HttpError as e:
+            if e.resp.status != 400:  # 400: マニフェストシートがまだない（アーカイブ未実施）
+                raise
+            sheet = {}
+        entries = sorted({(row[0], row[1]) for row in sheet.get('values', []) if len(row) >= 2 and re.match(r"\d{4}-\d{2}$", row[0])})
+        if self.loaded_at is not None and entries != self.entries:
+            # 他のプロセスがアーカイブした: Sheet1 の行が消えて行番号がずれたので全件取り直す
+            get_sheet_log().invalidate()
+        self.entries = entries
+        self.loaded_at = time.monotonic()
+
+    def recent_partitions(self):
+        """直近 lookback_months か月分のアーカイブの SheetLog を新しい順に返す"""
+        with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > self.manifest_ttl:
+                try:
+                    self.refresh_manifest()
+                except Exception as e:
+                    if self.loaded_at is None:
+                        raise
+                    logger.warning("archive manifest sync failed, using cached manifest: %s", e)
+                    self.loaded_at = time.monotonic()
+            titles = [title for month, title in self.entries[-self.lookback_months:]] if self.lookback_months > 0 else []
+            for title in titles:
+                if title not in self.partitions:
+                    self.partitions[title] = SheetLog(float("inf"), float("inf"), sheet=title)
+            return [self.partitions[title] for title in reversed(titles)]
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+@st.cache_resource
+def get_log_archive():
+    return LogArchive(SHEET_FULL_SYNC_INTERVAL, ARCHIVE_LOOKBACK_MONTHS)
+
+def log_partitions():
+    """
+    履歴を引く読み取り（過去の連絡帳・修正例）が見るパーティション: 今月の Sheet1 ＋ 直近の月別アーカイブ
+    当日分の読み取りは get_sheet_log() だけを使い、アーカイブには触れない
+    """
+    try:
+        archives = get_log_archive().recent_partitions()
+    except Exception as e:
+        logger.warning("archive unavailable, reading Sheet1 only: %s", e)
+        archives = []
+    return [get_sheet_log()] + archives
+
+def archive_old_rows():
+    """
+    Sheet1 のうち今月より前の行を月別アーカイブシート（Sheet1_YYYY-MM）へ移し、archive_manifest に記録する
+    アーカイブへの追記 → マニフェスト → Sheet1 からの削除の順に行うので、途中で失敗しても行は失われない
+    （削除前に失敗した場合、再実行するとアーカイブ側に重複しうる）
+    戻り値: 移した行数
+    """
+    # 送信待ちの行を先に書き出してから、Sheet1 を読み直す
+    if WRITE_FLUSH_INTERVAL > 0:
+        get_write_queue().flush()
+    current_month = datetime.datetime.now(JST).strftime("%Y-%m")
     service = get_gsp_service()
+    values = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range="Sheet1!A:I").execute().get('values', [])
+    by_month = {}  # 月 -> [Sheet1 の行位置]
+    for pos, row in enumerate(values):
+        if row and re.match(r"\d{4}-\d{2}-", row[0]) and row[0][:7] < current_month:
+            by_month.setdefault(row[0][:7], []).append(pos)
+    if not by_month:
+        return 0
+
+    meta = service.spreadsheets().get(spreadsheetId=SPREADSHEET_ID, fields="sheets.properties(sheetId,title)").execute()
+    sheet_ids = {sheet["properties"]["title"]: sheet["properties"]["sheetId"] for sheet in meta.get("sheets", [])}
+    missing = [title for title in [f"{ARCHIVE_SHEET_PREFIX}{month}" for month in sorted(by_month)] + [ARCHIVE_MANIFEST_SHEET]
+               if title not in sheet_ids]
+    if missing:
+        result = service.spreadsheets().batchUpdate(spreadsheetId=SPREADSHEET_ID, body={
+            'requests': [{'addSheet': {'properties': {'title': title}}} for title in missing]}).execute()
+        for reply in result.get("replies", []):
+            sheet_ids[reply["addSheet"]["properties"]["title"]] = reply["addSheet"]["properties"]["sheetId"]
+
+    archived_at = datetime.datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")
+    for month in sorted(by_month):
+        title = f"{ARCHIVE_SHEET_PREFIX}{month}"
+        # 読み取った表示文字列のまま残すため RAW で書く
+        service.spreadsheets().values().append(spreadsheetId=SPREADSHEET_ID, range=f"{title}!A:I", valueInputOption="RAW",
+                                               body={'values': [values[pos] for pos in by_month[month]]}).execute()
+    service.spreadsheets().values().append(spreadsheetId=SPREADSHEET_ID, range=f"{ARCHIVE_MANIFEST_SHEET}!A:D", valueInputOption="RAW",
+                                           body={'values': [[month, f"{ARCHIVE_SHEET_PREFIX}{month}", len(positions), archived_at]
+                                                            for month, positions in sorted(by_month.items())]}).execute()
+
+    # 連続する行をまとめ、後ろから削除する（前の行の位置がずれないように）
+    positions = sorted(pos for month_positions in by_month.values() for pos in month_positions)
+    spans = []
+    for pos in positions:
+        if spans and spans[-1][1] == pos:
+            spans[-1][1] = pos + 1
+        else:
+            spans.append([pos, pos + 1])
+    service.spreadsheets().batchUpdate(spreadsheetId=SPREADSHEET_ID, body={'requests': [
+        {'deleteDimension': {'range': {'sheetId': sheet_ids["Sheet1"], 'dimension': "ROWS", 'startIndex': start, 'endIndex': end}}}
+        for start, end in reversed(spans)]}).execute()
+
+    get_sheet_log().invalidate()
+    get_log_archive().invalidate()
+    logger.info("archived %d rows from Sheet1 into %d monthly sheets", len(positions), len(by_month))
+    return len(positions)
+
+def append_log_row(row):
+    """Sheet1に1行追記し、スナップショットにも書き込む"""
+    service = get_gsp_service()
+    body = {'values': [row]}
+    try:
+        result = service.spreadsheets().values().append(spreadsheetId=SPREADSHEET_ID, range="Sheet1!A:I", valueInputOption="USER_ENTERED", body=body).execute()
+    except Exception:
+        # 書き込まれたかどうか不明なので、次回の末尾同期で確認する
+        get_sheet_log().mark_stale()
+        raise
+    get_sheet_log().add_rows([row], result.get('updates', {}).get('updatedRange'))
+
+def prefetch_log_and_members():
+    """
+    Sheet1 と member のうち期限切れのものを、1回の values().batchGet でまとめて同期する
+    戻り値: 取得した範囲の数（0ならSheetsへの問い合わせなし）
+    """
+    sheet_log = get_sheet_log()
+    directory = get_staff_directory()
+    with sheet_log.lock, directory.lock:
+        ranges = []
+        log_sync = sheet_log.sync_range() if sheet_log.is_stale() else None
+        if log_sync:
+            ranges.append(log_sync[0])
+        members_stale = directory.is_stale()
+        if members_stale:
+            ranges.append("member!A:E")
+        if not ranges:
+            return 0
+        service = get_gsp_service()
+        result = service.spreadsheets().values().batchGet(spreadsheetId=SPREADSHEET_ID, ranges=ranges).execute()
+        value_ranges = iter(result.get('valueRanges', []))
+        if log_sync:
+            sheet_log.apply_sync(next(value_ranges).get('values', []), log_sync[1])
+        if members_stale:
+            directory.load(next(value_ranges).get('values', []))
+        return len(ranges)
+
+# Google Sheets の1セルに入る最大文字数
+SHEETS_CELL_MAX_CHARS = 50000
+
+def _cell_limit_error(row):
+    """行のどこかのセルが Sheets の文字数上限を超えていれば理由を返す（なければ None）"""
+    if any(len(str(value)) > SHEETS_CELL_MAX_CHARS for value in row):
+        return f"1セルの文字数上限（{SHEETS_CELL_MAX_CHARS}文字）を超えています"
+    return None
+
+def _is_permanent_write_error(e):
+    """再送しても通らない書き込みエラーか（408・429以外の4xx）"""
+    return isinstance(e, HttpError) and 400 <= e.resp.status < 500 and e.resp.status not in (408, 429)
+
+class LogWriteQueue:
+    """
+    Sheet1 への追記を溜めておき、flush 間隔ごとに全セッション分を1回の append にまとめて送る（write-behind）
+    - 送信待ちの行は SheetLog の保留行として即座に読み取りへ反映する
+    - 送信待ちの行はスプール（JSONLファイル、またはローカルミラーの outbox）にも書き、
+      失敗時はバックオフしながら再送、再起動後も再送する
+    - 再送しても通らない行は rejected に外し、残りの行を送り続ける
+    - プロセス終了時に残りを送る
+    応答が失われた場合は再送で重複しうる（少なくとも1回の書き込みを保証する）
+    """
+    def __init__(self, interval, spool):
+        self.interval = interval
+        self.spool = spool
+        self.pending = []
+        self.failures = 0
+        self.rejected = []  # 送信できずに外した行: [(行, 理由)]
+        self.lock = threading.Lock()        # pending・スプール・SheetLog の保留行
+        self.flush_lock = threading.Lock()  # 送信の直列化
+        sheet_log = get_sheet_log()
+        for row in self.spool.load():
+            self.pending.append(row)
+            sheet_log.add_pending(row)
+        threading.Thread(target=self._run, name="sheet1-write-queue", daemon=True).start()
+        atexit.register(self.flush)
+
+    def enqueue(self, row):
+        # SheetLog の保留行も同じロックの中で増減させ、送信待ちの行と同じ順番・件数に保つ
+        # （ロック外だと、送信済みの行が後から保留行に入って重複したり、並びがずれて別の行を消したりする）
+        with self.lock:
+            self.pending.append(row)
+            self.spool.add(row)
+            get_sheet_log().add_pending(row)
+
+    def flush(self):
+        """
+        送信待ちの行をまとめて送る。戻り値: 送信待ちが残っていなければ True
+        再送しても通らないエラー（429以外の4xx、セルの文字数超過）のときは1行ずつ送り直し、
+        通らない行だけを rejected に移して、後ろの行が詰まらないようにする
+        """
+        with self.flush_lock:
+            with self.lock:
+                batch = list(self.pending)
+            if not batch:
+                return True
+            try:
+                if not any(_cell_limit_error(row) for row in batch):
+                    self._commit(batch, self._append(batch))
+                    self.failures = 0
+                    return True
+            except Exception as e:
+                if not _is_permanent_write_error(e):
+                    return self._retry_later(len(batch), e)
+                logger.warning("Sheet1 write rejected, retrying %d rows one by one: %s", len(batch), e)
+            for row in batch:
+                reason = _cell_limit_error(row)
+                if reason is None:
+                    try:
+                        self._commit([row], self._append([row]))
+                        continue
+                    except Exception as e:
+                        if not _is_permanent_write_error(e):
+                            return self._retry_later(len(self.pending), e)
+                        reason = str(e)
+                self._reject(row, reason)
+            self.failures = 0
+            return True
+
+    def _append(self, rows):
+        service = get_gsp_service()
+        return service.spreadsheets().values().append(spreadsheetId=SPREADSHEET_ID, range="Sheet1!A:I", valueInputOption="USER_ENTERED", body={'values': rows}).execute()
+
+    def _commit(self, rows, result):
+        with self.lock:
+            del self.pending[:len(rows)]
+            self.spool.replace(self.pending)
+            get_sheet_log().commit_pending(len(rows), rows, result.get('updates', {}).get('updatedRange'))
+
+    def _reject(self, row, reason):
+        # 内容はログにも残す（画面ではメンテナンス欄に表示して、手で貼り直せるようにする）
+        logger.error("Sheet1 row rejected, removed from the write queue (%s): %s", reason, json.dumps(row, ensure_ascii=False))
+        with self.lock:
+            del self.pending[:1]
+            self.spool.replace(self.pending)
+            self.rejected.append((row, reason))
+            get_sheet_log().discard_pending(1)
+
+    def _retry_later(self, pending_count, error):
+        self.failures += 1
+        logger.warning("Sheet1 write failed (%d rows pending, attempt %d): %s", pending_count, self.failures, error)
+        return False
+
+    def _run(self):
+        while True:
+            # 失敗が続く間は間隔を倍々に延ばす（最大60秒）
+            time.sleep(min(self.interval * (2 ** self.failures), 60))
+            self.flush()
+
+@st.cache_resource
+def get_write_queue():
+    mirror = get_local_mirror()
+    return LogWriteQueue(WRITE_FLUSH_INTERVAL, SqliteOutbox(mirror) if mirror else JsonlSpool(WRITE_SPOOL_PATH))
+
+def enqueue_log_row(row):
+    """Sheet1への追記を書き込みキューに入れる（キュー無効時はその場で追記）"""
+    if WRITE_FLUSH_INTERVAL > 0:
+        get_write_queue().enqueue(row)
+    else:
+        append_log_row(row)
+
+@st.cache_resource
+def get_save_executor():
+    # このワーカーで送る書き込み（職員設定・連絡帳の確定）同士は、1本で順に送ることで追い越し合わない
+    # （書き込みキュー経由のメモ・ドラフト一時保存との順序は保証しないので、読み取り側は時刻で新しい方を選ぶ）
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sheets-save")
+    atexit.register(executor.shutdown)
+    return executor
+
+def submit_save(label, fn, *args, on_done=None):
+    """
+    Sheetsへの書き込み fn(*args) をスクリプトのスレッドから外して実行し、Future を返す
+    呼び出し側は結果を待たずに楽観的な状態を反映し、画面全体を再実行して render_save_status に確認を始めさせる。
+    完了は report_finished_saves が確認し、on_done(成功したか) で楽観的な状態を確定・巻き戻す。
+    失敗は「{label}エラー」としてトーストで知らせる
+    """
+    future = get_save_executor().submit(fn, *args)
+    st.session_state.setdefault("pending_saves", []).append((label, future, on_done))
+    return future
+
+def report_finished_saves():
+    """
+    このセッションで送った書き込みのうち完了したものを片付け、失敗をトーストで知らせる
+    書き込みキュー（メモ・ドラフト）の送信失敗が続いている場合も知らせる
+    戻り値: (まだ完了していない書き込みの数, 今回失敗が見つかったか)
+    """
+    # 前回見つかった失敗は、状態を戻した後の再実行でここに表示する
+    for message in st.session_state.pop("save_errors", []):
+        st.toast(message, icon="⚠️")
+    remaining = []
+    failed = False
+    for label, future, on_done in st.session_state.get("pending_saves", []):
+        if not future.done():
+            remaining.append((label, future, on_done))
+            continue
+        error = future.exception()
+        ok = error is None and future.result() is not False
+        if on_done:
+            on_done(ok)
+        if not ok:
+            failed = True
+            st.session_state.setdefault("save_errors", []).append(f"{label}エラー: {str(error) if error else '保存先が見つかりません'}")
+    st.session_state.pending_saves = remaining
+    if WRITE_FLUSH_INTERVAL > 0:
+        queue = get_write_queue()
+        failing = queue.failures > 0
+        if failing and not st.session_state.get("write_queue_warned"):
+            st.toast(f"記録の送信に失敗しています（{len(queue.pending)}件を再送待ち）", icon="⚠️")
+        st.session_state.write_queue_warned = failing
+        # 送信できずに外した行は、その後に開いていたセッションへ1回ずつ知らせる
+        seen = st.session_state.setdefault("write_queue_rejected_seen", len(queue.rejected))
+        for row, reason in queue.rejected[seen:]:
+            st.toast(f"{row[1]}さんの記録を保存できませんでした（{reason}）。メンテナンス欄から内容を確認できます", icon="⚠️")
+        st.session_state.write_queue_rejected_seen = len(queue.rejected)
+    return len(remaining), failed
+
+# MinHash の署名長と、各ハッシュ関数の係数（プロセス間で同じ値になるよう固定シードで作る）
+MINHASH_PERMUTATIONS = 64
+_MINHASH_PRIME = (1 << 61) - 1
+_minhash_rng = random.Random(20240601)
+_MINHASH_COEFFS = [(_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(_MINHASH_PRIME))
+                   for _ in range(MINHASH_PERMUTATIONS)]
+
+@functools.lru_cache(maxsize=4096)
+def memo_signature(text):
+    """メモの文字3-gram集合の MinHash 署名。戻り値: (署名, 3-gramの種類数)"""
+    text = re.sub(r"\s+", "", text)
+    shingles = {text[i:i + 3] for i in range(len(text) - 2)} or {text}
+    values = [int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big") for shingle in shingles]
+    signature = tuple(min((a * v + b) % _MINHASH_PRIME for v in values) for a, b in _MINHASH_COEFFS)
+    return signature, len(shingles)
+
+def memo_overlap(text_a, text_b):
+    """
+    2つのメモの重複率の推定値（短い方の3-gramのうち、長い方にも含まれる割合）
+    片方がもう片方の一部を貼り付けたものでも1に近くなる
+    """
+    (sig_a, size_a), (sig_b, size_b) = memo_signature(text_a), memo_signature(text_b)
+    jaccard = sum(1 for a, b in zip(sig_a, sig_b) if a == b) / MINHASH_PERMUTATIONS
+    intersection = jaccard / (1 + jaccard) * (size_a + size_b)
+    return min(1.0, intersection / min(size_a, size_b))
+
+def find_near_duplicate_memo(child_name, text, date_str=None):
+    """当日の同じ児童のメモのうち、text とほぼ同じ内容のもの（なければ None）"""
+    date_str = date_str or datetime.datetime.now(JST).strftime("%Y-%m-%d")
+    for row in reversed(get_sheet_log().find(child_name, date_str, "MEMO")):
+        if len(row) >= 3 and row[2] and memo_overlap(row[2], text) >= MEMO_DUP_THRESHOLD:
+            return row
+    return None
+
+def dedupe_memo_rows(rows):
+    """
+    ほぼ同じ内容のメモを1件にまとめる（長い方の本文を残し、どちらかがHIGHLIGHTならHIGHLIGHTにする）
+    戻り値: [(元の位置, 行)]（元の順番のまま）。位置は本文を残した方のメモのもの
+    （要約済みの古いメモより後の言い直しが長ければ、その言い直しは未要約として残る）
+    """
+    kept = []
+    for i, row in enumerate(rows):
+        if len(row) < 5:
+            continue
+        for k, (kept_i, kept_row) in enumerate(kept):
+            if memo_overlap(kept_row[2], row[2]) >= MEMO_DUP_THRESHOLD:
+                newer_wins = len(row[2]) > len(kept_row[2])
+                merged = list(row if newer_wins else kept_row)
+                if any(len(r) > 7 and r[7] == "HIGHLIGHT" for r in (kept_row, row)):
+                    merged += [""] * (8 - len(merged))
+                    merged[7] = "HIGHLIGHT"
+                kept[k] = (i if newer_wins else kept_i, merged)
+                break
+        else:
+            kept.append((i, row))
+    return sorted(kept, key=operator.itemgetter(0))
+
+def save_memo(child_name, text, staff_name, is_highlight=False):
     now = datetime.datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")
     tag = "HIGHLIGHT" if is_highlight else ""
-    body = {'values': [[now, child_name, text, "MEMO", staff_name, "", "", tag]]}
-    service.spreadsheets().values().append(spreadsheetId=SPREADSHEET_ID, range="Sheet1!A:H", valueInputOption="USER_ENTERED", body=body).execute()
+    duplicate = find_near_duplicate_memo(child_name, text, now[:10]) if MEMO_DUP_THRESHOLD < 1 else None
+    if duplicate:
+        # 保存はする（言い直しで情報が増えていることもある）。ドラフト作成時には1件にまとめる
+        st.toast(f"{duplicate[0][11:16]}のメモとほぼ同じ内容です（AIドラフトでは1件にまとめます）", icon="⚠️")
+    enqueue_log_row([now, child_name, text, "MEMO", staff_name, "", "", tag])
+    if MEMO_SUMMARY_BATCH > 0 and "ANTHROPIC_API_KEY" in st.secrets:
+        get_memo_summarizer().notify(child_name, now[:10], staff_name)
     return True
 
+def _append_final_report(now, child_name, ai_draft, final_text, next_hint, staff_name):
+    # 修正量をI列に保存しておき、get_high_diff_examples で再計算しないようにする
+    diff_score = _format_diff_score(_diff_score(ai_draft, final_text)) if ai_draft and final_text else ""
+    append_log_row([now, child_name, final_text, "REPORT", staff_name, next_hint, ai_draft, "", diff_score])
+
 def save_final_report(child_name, ai_draft, final_text, next_hint, staff_name):
-    service = get_gsp_service()
+    """
+    確定した連絡帳をバックグラウンドで追記する（Sheetsの応答は待たない）
+    送信中はこのセッションの saving_reports で確定後の内容を見せ、失敗したら編集内容を failed_reports に戻す
+    """
     now = datetime.datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")
-    body = {'values': [[now, child_name, final_text, "REPORT", staff_name, next_hint, ai_draft, ""]]}
-    service.spreadsheets().values().append(spreadsheetId=SPREADSHEET_ID, range="Sheet1!A:H", valueInputOption="USER_ENTERED", body=body).execute()
+    st.session_state.setdefault("saving_reports", {})[child_name] = (final_text, next_hint)
+    st.session_state.get("failed_reports", {}).pop(child_name, None)
+
+    def on_done(ok):
+        if st.session_state.get("saving_reports", {}).get(child_name) == (final_text, next_hint):
+            del st.session_state.saving_reports[child_name]
+        if not ok:
+            st.session_state.setdefault("failed_reports", {})[child_name] = (ai_draft, f"{final_text}\n<<<INTERNAL>>>\n{next_hint}")
+
+    submit_save("連絡帳保存", _append_final_report, now, child_name, ai_draft, final_text, next_hint, staff_name, on_done=on_done)
     return True
 
-def save_ai_draft_temp(child_name, ai_draft, staff_name):
-    """AIドラフトを一時保存（未確定状態）"""
-    service = get_gsp_service()
+def save_ai_draft_temp(child_name, ai_draft, staff_name, fingerprint=""):
+    """
+    AIドラフトを一時保存（未確定状態）
+    fingerprint（先読みで作ったドラフトの元になったメモの memo_fingerprint）を渡すとH列に記録し、
+    その後メモが増えたら復元・一括作成の対象判定で無視されるようにする
+    """
     now = datetime.datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")
+    tag = f"{SPECULATIVE_TAG_PREFIX}{fingerprint}" if fingerprint else ""
     # 本文を空にして、AIドラフトのみ保存（未確定状態を表す）
-    body = {'values': [[now, child_name, "", "REPORT", staff_name, "", ai_draft, ""]]}
-    service.spreadsheets().values().append(spreadsheetId=SPREADSHEET_ID, range="Sheet1!A:H", valueInputOption="USER_ENTERED", body=body).execute()
+    enqueue_log_row([now, child_name, "", "REPORT", staff_name, "", ai_draft, tag])
     return True
 
+# 先読みドラフトのH列: 元になったメモの指紋（例: "SPEC:1a2b3c..."）
+SPECULATIVE_TAG_PREFIX = "SPEC:"
+
+def memo_fingerprint(child_name, date_str=None):
+    """その日のMEMO行の内容から作る指紋（メモが追加・変更されると変わる）"""
+    date_str = date_str or datetime.datetime.now(JST).strftime("%Y-%m-%d")
+    digest = hashlib.sha256()
+    for row in get_sheet_log().find(child_name, date_str, "MEMO"):
+        digest.update(json.dumps(row[:8], ensure_ascii=False).encode())
+    return digest.hexdigest()[:16]
+
+def _is_stale_speculative(row, fingerprint):
+    """先読みで作ったドラフト行のうち、その後メモが変わったもの"""
+    return len(row) > 7 and row[7].startswith(SPECULATIVE_TAG_PREFIX) and row[7][len(SPECULATIVE_TAG_PREFIX):] != fingerprint
+
 def fetch_todays_memos(child_name):
     """当日のメモ一覧を取得"""
-    service = get_gsp_service()
-    sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range="Sheet1!A:H").execute()
-    rows = sheet.get('values', [])
     today_str = datetime.datetime.now(JST).strftime("%Y-%m-%d")
     memos = []
-    for row in rows:
-        if len(row) >= 5 and row[1] == child_name and row[0].startswith(today_str) and row[3] == "MEMO":
+    for row in get_sheet_log().find(child_name, today_str, "MEMO"):
+        if len(row) >= 5:
             highlight_tag = "⭐" if len(row) > 7 and row[7] == "HIGHLIGHT" else ""
             memos.append(f"・{row[0][11:16]} [{row[4]}] {highlight_tag}{row[2]}")
     return "\n".join(memos)
 
+def fetch_todays_memo_text(child_name):
+    """当日のメモの本文だけを改行でつなげたもの（時刻・記入者などの表示用の装飾を含めない。過去の連絡帳の検索語に使う）"""
+    today_str = datetime.datetime.now(JST).strftime("%Y-%m-%d")
+    return "\n".join(row[2] for row in get_sheet_log().find(child_name, today_str, "MEMO") if len(row) >= 5)
+
 def get_todays_report(child_name):
     """
     当日の既に作成済みレポートがあれば取得して返す（永続化対応）
     戻り値: (public_text, internal_text) または (None, None)
     """
     try:
-        service = get_gsp_service()
-        # 最新のデータから探すため全取得
-        sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range="Sheet1!A:H").execute()
-        rows = sheet.get('values', [])
         today_str = datetime.datetime.now(JST).strftime("%Y-%m-%d")
         
-        # 後ろから走査して、今日の最新のREPORTを探す
-        for row in reversed(rows):
-            if len(row) >= 4:
-                # 日付一致 AND 名前一致 AND タイプがREPORT
-                if row[0].startswith(today_str) and row[1] == child_name and row[3] == "REPORT":
-                    final_text = row[2]
-                    next_hint = row[5] if len(row) > 5 else ""
-                    return final_text, next_hint
+        # 今日のREPORT（インデックスから取得）のうち、本文のある最新のものを返す
+        # （AIドラフトの一時保存は書き込みキュー経由なので、確定した行より後ろに並ぶことがある。時刻で選ぶ）
+        reports = [row for row in get_sheet_log().find(child_name, today_str, "REPORT") if len(row) > 2 and row[2]]
+        if reports:
+            row = max(reversed(reports), key=operator.itemgetter(0))
+            final_text = row[2]
+            next_hint = row[5] if len(row) > 5 else ""
+            return final_text, next_hint
         return None, None
     except Exception as e:
         st.error(f"今日のレポート取得エラー: {str(e)}")
@@ -253,61 +1511,360 @@ def get_todays_ai_draft(child_name):
     戻り値: ai_draft文字列 または None
     """
     try:
-        service = get_gsp_service()
-        # H列（タグ）も含めて全取得
-        sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range="Sheet1!A:H").execute()
-        rows = sheet.get('values', [])
         today_str = datetime.datetime.now(JST).strftime("%Y-%m-%d")
         
-        # 後ろから走査して、今日の最新のAIドラフト（未確定）を探す
-        for row in reversed(rows):
-            if len(row) >= 7:
-                # 日付一致 AND 名前一致 AND タイプがREPORT AND AIドラフトが存在
-                if (row[0].startswith(today_str) and 
-                    row[1] == child_name and 
-                    row[3] == "REPORT" and 
-                    row[6]):  # G列（AIドラフト）に内容がある
-                    # 本文（C列）が空または極短い場合は未確定と判断
-                    if not row[2] or len(row[2].strip()) < 10:
-                        return row[6]  # AIドラフトを返す
+        # 今日のREPORT（インデックスから取得）を後ろから走査して、最新のAIドラフト（未確定）を探す
+        fingerprint = None
+        for row in reversed(get_sheet_log().find(child_name, today_str, "REPORT")):
+            if len(row) > 7 and row[7].startswith(SPECULATIVE_TAG_PREFIX):
+                # 先読みドラフトは、作成後にメモが増えていれば使わない
+                fingerprint = fingerprint or memo_fingerprint(child_name, today_str)
+                if _is_stale_speculative(row, fingerprint):
+                    continue
+            if len(row) >= 7 and row[6]:  # G列（AIドラフト）に内容がある
+                # 本文（C列）が空または極短い場合は未確定と判断
+                if not row[2] or len(row[2].strip()) < 10:
+                    return row[6]  # AIドラフトを返す
         return None
     except Exception as e:
         st.error(f"今日のAIドラフト取得エラー: {str(e)}")
         return None
 
-def get_past_reports(child_name, limit=3):
+def get_past_reports(child_name, limit=3, query=None):
     """
     その児童の過去の連絡帳を新しい順に最大limit件取得（当日分は除外）
+    query（当日のメモの本文など）を渡すと、関連度の高い順に選ぶ（足りない分は新しい順で補う）
     戻り値: 過去の連絡帳テキストのリスト
     """
     try:
-        service = get_gsp_service()
-        sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range="Sheet1!A:H").execute()
-        rows = sheet.get('values', [])
         today_str = datetime.datetime.now(JST).strftime("%Y-%m-%d")
+
+        # 今月分（Sheet1）と、参照対象の月別アーカイブから探す
+        partitions = log_partitions()
+
+        relevant = []
+        if query and PAST_REPORT_RETRIEVAL:
+            # パーティションごとの idf・平均語数ではスコアを比べられないので、全パーティションを1つのコーパスとして採点する
+            stats = [stat for stat in (sheet_log.report_stats(child_name, query) for sheet_log in partitions) if stat]
+            corpus = merge_report_stats(stats) if stats else None
+            hits = [hit for sheet_log in partitions
+                    for hit in sheet_log.relevant_reports(child_name, query, limit, exclude_date=today_str, corpus=corpus)]
+            relevant = [row[2] for score, row in heapq.nlargest(limit, hits, key=operator.itemgetter(0))]
+            if len(relevant) >= limit:
+                return relevant
         
         # 該当児童のREPORTレコードを抽出（当日以外かつ本文が存在するもの）
-        past_reports = []
-        for row in rows:
-            if (len(row) >= 4 and 
-                row[1] == child_name and 
-                row[3] == "REPORT" and 
-                not row[0].startswith(today_str) and  # 当日分は除外
-                len(row) >= 3 and row[2] and len(row[2].strip()) > 10):  # 本文が存在
-                past_reports.append({
-                    'timestamp': row[0],
-                    'text': row[2]
-                })
-        
-        # タイムスタンプでソート（新しい順）
-        past_reports.sort(key=lambda x: x['timestamp'], reverse=True)
-        
+        # パーティションは新しい順に並び、前のものほど行も新しいので、足りた時点で古い月は読まない
+        recent = []
+        for sheet_log in partitions:
+            past_reports = [row for row in sheet_log.child_reports(child_name)
+                            if not row[0].startswith(today_str)  # 当日分は除外
+                            and len(row) >= 3 and row[2] and len(row[2].strip()) > 10  # 本文が存在
+                            and row[2] not in relevant]
+            # タイムスタンプでソート（新しい順）
+            past_reports.sort(key=operator.itemgetter(0), reverse=True)
+            recent.extend(row[2] for row in past_reports)
+            if len(relevant) + len(recent) >= limit:
+                break
+
         # 最大limit件まで取得してテキストのみ返す
-        return [report['text'] for report in past_reports[:limit]]
+        return relevant + recent[:limit - len(relevant)]
     except Exception as e:
         st.error(f"過去の連絡帳取得エラー: {str(e)}")
         return []
 
+AUDIO_TARGET_RATE = 16000
+VAD_FRAME_MS = 30
+VAD_PADDING_MS = 300      # 発話区間の前後に残す余白
+VAD_MAX_GAP_MS = 500      # これより短い無音は発話の一部として残す
+VAD_NOISE_WINDOW_MS = 300 # 環境ノイズの推定に使う、最も静かな区間の長さ
+
+@dataclass(frozen=True)
+class PreparedAudio:
+    """Whisperへ送る前処理済み音声"""
+    data: bytes
+    filename: str
+    mime: str
+    original_bytes: int
+    original_seconds: float = 0.0
+    speech_seconds: float = 0.0
+    elapsed_ms: float = 0.0
+    pcm: bytes = b""          # data の元になった16kHzモノラルPCM（長い録音の分割用）
+    cut_points: tuple = ()    # pcm 内の無音のつなぎ目（サンプル位置）
+
+def _detect_speech(pcm, rate):
+    """
+    16bitモノラルPCMからエネルギーベースで発話区間を検出する
+    戻り値: [(開始サンプル, 終了サンプル)]（前後に余白を付け、短い無音で区切られた区間は結合済み）
+    """
+    frame = rate * VAD_FRAME_MS // 1000
+    energies = [audioop.rms(pcm[i * 2:(i + frame) * 2], 2) for i in range(0, len(pcm) // 2, frame)]
+    if not energies:
+        return []
+    # 最も静かな VAD_NOISE_WINDOW_MS 区間の平均を環境ノイズとみなし、その2.5倍（最低200）を発話のしきい値にする
+    # （静かなフレームの割合で決めると、無音が少ない録音ではノイズを発話の音量と取り違える）
+    window = max(1, min(len(energies), VAD_NOISE_WINDOW_MS // VAD_FRAME_MS))
+    window_sum = sum(energies[:window])
+    min_sum = window_sum
+    for i in range(window, len(energies)):
+        window_sum += energies[i] - energies[i - window]
+        min_sum = min(min_sum, window_sum)
+    noise_floor = min_sum / window
+    threshold = max(noise_floor * 2.5, 200)
+    padding = VAD_PADDING_MS // VAD_FRAME_MS
+    max_gap = VAD_MAX_GAP_MS // VAD_FRAME_MS
+    segments = []
+    for i, energy in enumerate(energies):
+        if energy < threshold:
+            continue
+        start, end = max(0, i - padding), min(len(energies), i + 1 + padding)
+        if segments and start - segments[-1][1] <= max_gap:
+            segments[-1][1] = max(segments[-1][1], end)
+        else:
+            segments.append([start, end])
+    total = len(pcm) // 2
+    return [(start * frame, min(end * frame, total)) for start, end in segments]
+
+def _encode_wav(pcm, rate):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(pcm)
+    return buffer.getvalue()
+
+def _encode_compact(wav_bytes, codec):
+    """ffmpegがあれば圧縮コーデックに変換する。戻り値: (データ, ファイル名, MIME) または None"""
+    if not codec or not shutil.which("ffmpeg"):
+        return None
+    formats = {"opus": ("libopus", "ogg", "audio/ogg"), "mp3": ("libmp3lame", "mp3", "audio/mpeg")}
+    if codec not in formats:
+        return None
+    encoder, container, mime = formats[codec]
+    result = subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-f", "wav", "-i", "pipe:0", "-c:a", encoder, "-b:a", "24k", "-f", container, "pipe:1"],
+        input=wav_bytes, capture_output=True, timeout=30,
+    )
+    if result.returncode != 0 or not result.stdout:
+        return None
+    return result.stdout, f"audio.{container}", mime
+
+def _decode_to_pcm16_mono(audio_bytes):
+    """WAVを16kHz・16bit・モノラルのPCMに変換する。WAV以外なら None"""
+    try:
+        with wave.open(io.BytesIO(audio_bytes), "rb") as w:
+            channels, width, rate = w.getnchannels(), w.getsampwidth(), w.getframerate()
+            pcm = w.readframes(w.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    if width != 2:
+        pcm = audioop.lin2lin(pcm, width, 2)
+    if channels == 2:
+        pcm = audioop.tomono(pcm, 2, 0.5, 0.5)
+    elif channels > 2:
+        return None
+    if rate != AUDIO_TARGET_RATE:
+        pcm, _ = audioop.ratecv(pcm, 2, 1, rate, AUDIO_TARGET_RATE, None)
+    return pcm
+
+def preprocess_audio(audio_bytes):
+    """
+    録音を軽くしてから送るための前処理: 16kHzモノラル化 → 無音区間の除去 → （任意）圧縮コーデック
+    WAV以外や audioop が無い環境では元の音声をそのまま返す
+    """
+    started = time.perf_counter()
+    original = PreparedAudio(audio_bytes, "audio.wav", "audio/wav", len(audio_bytes))
+    if not AUDIO_PREPROCESS or audioop is None:
+        return original
+    pcm = _decode_to_pcm16_mono(audio_bytes)
+    if pcm is None:
+        return original
+    segments = _detect_speech(pcm, AUDIO_TARGET_RATE)
+    cut_points = []
+    if segments:
+        # 区間のつなぎ目に短い無音を挟み、語が不自然につながらないようにする
+        gap = b"\x00\x00" * (AUDIO_TARGET_RATE // 10)
+        parts = []
+        offset = 0
+        for start, end in segments:
+            if parts:
+                parts.append(gap)
+                cut_points.append(offset + len(gap) // 4)  # 無音の真ん中
+                offset += len(gap) // 2
+            parts.append(pcm[start * 2:end * 2])
+            offset += end - start
+        pcm_speech = b"".join(parts)
+    else:
+        pcm_speech = pcm  # 発話を検出できなければ削らずに送る
+    data, filename, mime = _encode_wav(pcm_speech, AUDIO_TARGET_RATE), "audio.wav", "audio/wav"
+    encoded = _encode_compact(data, AUDIO_ENCODE_CODEC)
+    if encoded:
+        data, filename, mime = encoded
+    return PreparedAudio(
+        data, filename, mime, len(audio_bytes),
+        original_seconds=len(pcm) / 2 / AUDIO_TARGET_RATE,
+        speech_seconds=len(pcm_speech) / 2 / AUDIO_TARGET_RATE,
+        elapsed_ms=round((time.perf_counter() - started) * 1000, 1),
+        pcm=pcm_speech, cut_points=tuple(cut_points),
+    )
+
+def split_audio_chunks(audio):
+    """
+    長い録音を AUDIO_CHUNK_SECONDS 前後のチャンクに分ける（できるだけ無音のつなぎ目で切る）
+    各チャンクの先頭には前のチャンクの末尾 AUDIO_CHUNK_OVERLAP_SECONDS 秒を重ねる
+    戻り値: [(ファイル名, データ, MIME)]
+    """
+    chunk_len = int(AUDIO_CHUNK_SECONDS * AUDIO_TARGET_RATE)
+    total = len(audio.pcm) // 2
+    if not audio.pcm or total <= chunk_len * 1.2:
+        return [(audio.filename, audio.data, audio.mime)]
+    overlap = int(AUDIO_CHUNK_OVERLAP_SECONDS * AUDIO_TARGET_RATE)
+    bounds = []
+    start = 0
+    while total - start > chunk_len * 1.2:
+        target = start + chunk_len
+        # 目標位置より手前で、チャンクが短くなりすぎない範囲の最後の無音で切る（無ければ目標位置で切る）
+        candidates = [c for c in audio.cut_points if start + chunk_len // 2 < c <= target]
+        cut = candidates[-1] if candidates else target
+        bounds.append((start, cut))
+        start = cut
+    bounds.append((start, total))
+    chunks = []
+    for i, (start, end) in enumerate(bounds):
+        pcm = audio.pcm[max(0, start - overlap) * 2:end * 2]
+        data, filename, mime = _encode_wav(pcm, AUDIO_TARGET_RATE), f"chunk{i}.wav", "audio/wav"
+        encoded = _encode_compact(data, AUDIO_ENCODE_CODEC)
+        if encoded:
+            data, filename, mime = encoded[0], f"chunk{i}.{encoded[1].rsplit('.', 1)[1]}", encoded[2]
+        chunks.append((filename, data, mime))
+    return chunks
+
+def _is_fuzzy_overlap(tail, head, min_ratio):
+    """
+    前のチャンクの末尾 tail と次のチャンクの先頭 head が、言い回しの揺れを除いて同じ区間か
+    一致する文字が長い方の min_ratio 以上あり、かつ両者の最後の文字がそろって一致していること
+    （最後がそろわないものは、head が重なりの先の新しい発話まで含んでいる）
+    """
+    blocks = difflib.SequenceMatcher(None, tail, head, autojunk=False).get_matching_blocks()
+    last = blocks[-2] if len(blocks) > 1 else None
+    return (last is not None
+            and last.a + last.size == len(tail) and last.b + last.size == len(head)
+            and sum(block.size for block in blocks) >= min_ratio * max(len(tail), len(head)))
+
+
+def _stitch_transcripts(texts, window=20, min_match=2, fuzzy_min=5, fuzzy_ratio=0.8):
+    """
+    チャンクごとの文字起こしをつなげる。前の末尾と次の先頭が重なる部分（重ねた区間・window 文字以内）だけを片方落とす
+    - min_match 文字以上で、末尾と先頭がそのまま一致すれば重なりとみなす
+    - fuzzy_min 文字以上なら、言い回しが少し違っても（長さ±2文字・_is_fuzzy_overlap）重なりとみなす
+      （Whisper は重ねた区間を両方のチャンクで同じ文字列にするとは限らないため）
+    途中の語尾（「ました。」など）が一致しただけでは削らず、重なりが見つからなければそのままつなげる
+    """
+    merged = texts[0] if texts else ""
+    for text in texts[1:]:
+        overlap = 0
+        for head in range(min(window, len(text)), min_match - 1, -1):
+            if merged.endswith(text[:head]) or (head >= fuzzy_min and any(
+                    _is_fuzzy_overlap(merged[-tail:], text[:head], fuzzy_ratio)
+                    for tail in range(head - 2, head + 3) if 0 < tail <= len(merged))):
+                overlap = head
+                break
+        merged += text[overlap:]
+    return merged
+
+def _transcribe_chunks(chunks, prompt):
+    """
+    チャンクを上限付きスレッドプールで並列に文字起こしする
+    各チャンクには共通のpromptに加え、開始時点で前のチャンクが終わっていればその末尾の文章も渡す
+    （並列実行なので、前のチャンクを待つことはしない）
+    """
+    results = {}
+    def run(i, chunk):
+        chunk_prompt = prompt
+        if i - 1 in results:
+            chunk_prompt = f"{prompt}{results[i - 1][-AUDIO_PROMPT_TAIL_CHARS:]}"
+        transcript = openai.audio.transcriptions.create(model="whisper-1", file=chunk, language="ja", prompt=chunk_prompt)
+        results[i] = transcript.text
+        return transcript.text
+    with ThreadPoolExecutor(max_workers=AUDIO_CHUNK_WORKERS) as pool:
+        texts = list(pool.map(run, range(len(chunks)), chunks))
+    return _stitch_transcripts(texts)
+
+class TranscriptCache:
+    """
+    音声データ・prompt・モデルのハッシュをキーに文字起こし結果を保持するLRUキャッシュ
+    テキストの合計バイト数が max_bytes を超えたら古いものから捨てる。directory を指定するとファイルにも保存する
+    """
+    def __init__(self, max_bytes, directory=""):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()  # key -> text
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            # 更新の古い順に読み込み、最近使ったものがLRUの末尾に来るようにする
+            paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".txt")]
+            for path in sorted(paths, key=os.path.getmtime):
+                with open(path, encoding="utf-8") as f:
+                    self._store(os.path.basename(path)[:-4], f.read())
+
+    @staticmethod
+    def make_key(audio_bytes, prompt, model):
+        digest = hashlib.sha256()
+        for part in (model.encode(), b"\0", prompt.encode(), b"\0", audio_bytes):
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.txt")
+
+    def _store(self, key, text):
+        if key in self.entries:
+            self.size -= len(self.entries.pop(key).encode())
+        self.entries[key] = text
+        self.size += len(text.encode())
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            old_key, old_text = self.entries.popitem(last=False)
+            self.size -= len(old_text.encode())
+            if self.directory:
+                try:
+                    os.remove(self._path(old_key))
+                except OSError:
+                    pass
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            if self.directory:
+                try:
+                    os.utime(self._path(key))
+                except OSError:
+                    pass
+            return self.entries[key]
+
+    def put(self, key, text):
+        with self.lock:
+            self._store(key, text)
+            if self.directory and key in self.entries:
+                with open(self._path(key), "w", encoding="utf-8") as f:
+                    f.write(text)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.size}
+
+@st.cache_resource
+def get_transcript_cache():
+    return TranscriptCache(TRANSCRIPT_CACHE_MAX_BYTES, TRANSCRIPT_CACHE_DIR)
+
 def transcribe_audio(audio_file, child_names: list = None):
     try:
         # prompt生成: 児童名リストと放課後等デイサービスでよく使われる語彙
@@ -329,14 +1886,36 @@ def transcribe_audio(audio_file, child_names: list = None):
         # promptを結合
         prompt = "。".join(prompt_parts) + "。"
         
-        # Whisper API呼び出しにpromptパラメータを追加
-        transcript = openai.audio.transcriptions.create(
-            model="whisper-1", 
-            file=audio_file, 
-            language="ja",
-            prompt=prompt
-        )
-        return transcript.text
+        # 同じ音声・promptは再実行や再アップロードでも一度しか送らない
+        audio_bytes = audio_file.getvalue() if hasattr(audio_file, "getvalue") else audio_file.read()
+        cache = get_transcript_cache()
+        cache_key = cache.make_key(audio_bytes, prompt, "whisper-1")
+        cached = cache.get(cache_key)
+        if cached is not None:
+            st.session_state.last_audio_stats = None
+            return cached
+
+        # 無音カット・16kHzモノラル化してから送る
+        audio = preprocess_audio(audio_bytes)
+        logger.info("audio preprocess: %d -> %d bytes, %.1fs -> %.1fs, %.1fms",
+                    audio.original_bytes, len(audio.data), audio.original_seconds, audio.speech_seconds, audio.elapsed_ms)
+        st.session_state.last_audio_stats = audio
+
+        # 長い録音は無音のつなぎ目で分割し、並列に文字起こしする
+        chunks = split_audio_chunks(audio)
+        if len(chunks) > 1:
+            text = _transcribe_chunks(chunks, prompt)
+        else:
+            # Whisper API呼び出しにpromptパラメータを追加
+            transcript = openai.audio.transcriptions.create(
+                model="whisper-1", 
+                file=chunks[0], 
+                language="ja",
+                prompt=prompt
+            )
+            text = transcript.text
+        cache.put(cache_key, text)
+        return text
     except Exception as e:
         st.error(f"音声転写エラー: {str(e)}")
         return None
@@ -419,31 +1998,333 @@ def get_default_internal_prompt(child_name, staff_name, manual_instruction, dyna
     {dynamic_instruction}
     """
 
-def fetch_todays_memos_with_tags(child_name):
-    """当日のメモをタグ付き情報込みで取得"""
-    service = get_gsp_service()
-    sheet = service.spreadsheets().values().get(spreadsheetId=SPREADSHEET_ID, range="Sheet1!A:H").execute()
-    rows = sheet.get('values', [])
+def fetch_todays_memos_with_tags(child_name, skip=0):
+    """
+    当日のメモをタグ付き情報込みで取得
+    skip を渡すと、先頭 skip 件（要約済み）の通常メモを除く（HIGHLIGHTメモは常にすべて返す）
+    """
     today_str = datetime.datetime.now(JST).strftime("%Y-%m-%d")
     
     highlighted_memos = []
     normal_memos = []
     
-    for row in rows:
-        if len(row) >= 5 and row[1] == child_name and row[0].startswith(today_str) and row[3] == "MEMO":
+    # ほぼ同じ内容のメモはまとめてからプロンプトに入れる
+    rows = get_sheet_log().find(child_name, today_str, "MEMO")
+    for i, row in (dedupe_memo_rows(rows) if MEMO_DUP_THRESHOLD < 1 else enumerate(rows)):
+        if len(row) >= 5:
             memo_text = f"・{row[0][11:16]} [{row[4]}] {row[2]}"
             if len(row) > 7 and row[7] == "HIGHLIGHT":
                 highlighted_memos.append(memo_text)
-            else:
+            elif i >= skip:
                 normal_memos.append(memo_text)
     
     # HIGHLIGHTタグ付きのメモを優先して結合
     all_memos = highlighted_memos + normal_memos
     return "\n".join(all_memos), highlighted_memos
 
-def generate_draft(child_name, memos, staff_name, manual_style, custom_prompt=None, custom_prompt_internal=None, past_reports=None):
+# SUMMARY行のH列: 要約に畳み込み済みのMEMO件数（例: "MEMOS:12"）
+SUMMARY_COVERED_PREFIX = "MEMOS:"
+
+def _parse_memo_summary(rows):
+    """SUMMARY行のリストから最新の要約を取り出す。戻り値: (要約, 畳み込み済みMEMO件数)"""
+    for row in reversed(rows):
+        if len(row) > 7 and row[7].startswith(SUMMARY_COVERED_PREFIX):
+            try:
+                return row[2], int(row[7][len(SUMMARY_COVERED_PREFIX):])
+            except ValueError:
+                continue
+    return "", 0
+
+def fetch_todays_memo_summary(child_name):
+    """当日のメモの要約（MemoSummarizer が書いたSUMMARY行）を取得。戻り値: (要約, 畳み込み済みMEMO件数)"""
+    today_str = datetime.datetime.now(JST).strftime("%Y-%m-%d")
+    return _parse_memo_summary(get_sheet_log().find(child_name, today_str, "SUMMARY"))
+
+def summarize_memos(child_name, previous_summary, new_memos, client=None):
+    """これまでの要約に新しいメモを畳み込んだ要約を返す"""
+    system = f"""
+    あなたは放課後等デイサービスのスタッフです。
+    夕方に{child_name}さんの連絡帳を書くための材料として、今日の記録を要約しています。
+    「これまでの要約」に「新しいメモ」の内容を加えて、更新した要約だけを出力してください。
+
+    # ルール
+    1. 活動内容・本人の様子や発言・体調・保護者に伝えるべき事項は落とさない。
+    2. 時刻と記録した職員名（[ ]内）は、出来事の順番がわかる程度に残す。
+    3. 音声認識の誤認識と思われる意味不明な部分は捨てる。
+    4. 推測で内容を補わない。全体で600字以内に収める。
+    """
+    content = f"【これまでの要約】\n{previous_summary or '（まだありません）'}\n\n【新しいメモ】\n" + "\n".join(new_memos)
+    message = (client or anthropic_client).messages.create(
+        model=MEMO_SUMMARY_MODEL, max_tokens=1000, temperature=0,
+        system=system, messages=[{"role": "user", "content": content}]
+    )
+    return message.content[0].text.strip()
+
+class MemoSummarizer:
+    """
+    save_memo のたびに通知を受け、(児童, 日付) ごとの要約にまだ要約していないメモを畳み込む（バックグラウンド）
+    未要約のメモが batch 件以上たまったときだけLLMを呼び、結果はSUMMARY行として書き込みキューに入れる
+    """
+    def __init__(self, batch, sheet_log, write_row):
+        self.batch = batch
+        self.sheet_log = sheet_log
+        self.write_row = write_row
+        self.dirty = {}  # (child, date) -> 最後にメモを保存した職員
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        threading.Thread(target=self._run, name="memo-summarizer", daemon=True).start()
+
+    def notify(self, child_name, date_str, staff_name):
+        with self.lock:
+            self.dirty[(child_name, date_str)] = staff_name
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            with self.lock:
+                items = list(self.dirty.items())
+                self.dirty.clear()
+            for (child_name, date_str), staff_name in items:
+                try:
+                    self.fold(child_name, date_str, staff_name)
+                except Exception as e:
+                    logger.warning("memo summary failed for %s: %s", child_name, e)
+
+    def fold(self, child_name, date_str, staff_name, client=None):
+        """未要約のメモが batch 件以上あれば要約に畳み込む。戻り値: 新しい要約 または None"""
+        memos = self.sheet_log.find(child_name, date_str, "MEMO")
+        summary, covered = _parse_memo_summary(self.sheet_log.find(child_name, date_str, "SUMMARY"))
+        if len(memos) - covered < self.batch:
+            return None
+        new_rows = [row for row in memos[covered:] if len(row) >= 5]
+        started = time.perf_counter()
+        new_summary = summarize_memos(child_name, summary, [f"・{row[0][11:16]} [{row[4]}] {row[2]}" for row in new_rows], client)
+        now = datetime.datetime.now(JST).strftime("%Y-%m-%d %H:%M:%S")
+        self.write_row([now, child_name, new_summary, "SUMMARY", staff_name, "", "", f"{SUMMARY_COVERED_PREFIX}{len(memos)}"])
+        logger.info("memo summary for %s: %d -> %d memos in %.0fms",
+                    child_name, covered, len(memos), (time.perf_counter() - started) * 1000)
+        return new_summary
+
+@st.cache_resource
+def get_memo_summarizer():
+    return MemoSummarizer(MEMO_SUMMARY_BATCH, get_sheet_log(), enqueue_log_row)
+
+@dataclass(frozen=True)
+class DraftContext:
+    """ドラフト生成に必要な入力一式（assemble_draft_context で作る）"""
+    child_name: str
+    staff_name: str
+    memos: str                   # 表示用の当日メモ（fetch_todays_memos と同じ形式）
+    structured_memos: str        # HIGHLIGHT優先で並べた当日メモ
+    highlighted_memos: tuple
+    past_reports: tuple
+    custom_prompt: str
+    custom_prompt_internal: str
+    dynamic_examples: tuple
+    memo_summary: str = ""       # 要約済みのメモ（structured_memos はその続きのメモとHIGHLIGHTメモだけになる）
+    timings: dict = field(default_factory=dict)  # 段階名 -> 所要ミリ秒
+
+def assemble_draft_context(child_name, staff_name):
+    """
+    「AIドラフト作成」に必要なデータをまとめて用意する
+    Sheetsへの問い合わせは最初の batchGet（期限切れのときだけ）に集約し、以降はキャッシュから引く
+    """
+    timings = {}
+    def timed(stage, fn, *args, **kwargs):
+        started = time.perf_counter()
+        result = fn(*args, **kwargs)
+        timings[stage] = round((time.perf_counter() - started) * 1000, 1)
+        return result
+
+    timed("sync", prefetch_log_and_members)
+    memos = timed("memos", fetch_todays_memos, child_name)
+    memo_summary, summarized_count = timed("memo_summary", fetch_todays_memo_summary, child_name)
+    structured_memos, highlighted_memos = timed("tagged_memos", fetch_todays_memos_with_tags, child_name, skip=summarized_count)
+    past_reports = timed("past_reports", lambda: get_past_reports(child_name, limit=3, query=fetch_todays_memo_text(child_name)))
+    custom_prompt = timed("custom_prompt", get_staff_custom_prompt, staff_name)
+    custom_prompt_internal = timed("custom_prompt_internal", get_staff_custom_prompt_internal, staff_name)
+    dynamic_examples = timed("diff_examples", get_high_diff_examples, staff_name, limit=3)
+    logger.info("draft context for %s: %s", child_name, timings)
+    return DraftContext(
+        child_name=child_name, staff_name=staff_name,
+        memos=memos, structured_memos=structured_memos, highlighted_memos=tuple(highlighted_memos),
+        past_reports=tuple(past_reports),
+        custom_prompt=custom_prompt, custom_prompt_internal=custom_prompt_internal,
+        dynamic_examples=tuple(dynamic_examples), memo_summary=memo_summary, timings=timings,
+    )
+
+# ドラフト生成に失敗したときに返す文字列
+DRAFT_ERROR_TEXT = "エラーが発生しました"
+
+# 児童ごとのプロンプト本文で、文体見本・修正例の代わりに差し込む文
+STAFF_PREFIX_REFERENCE = "冒頭の【共通の文体・修正パターン】に従ってください。"
+
+def build_staff_prompt_prefix(staff_name, manual_instruction, dynamic_instruction):
+    """
+    職員単位で共通のsystemプロンプト先頭ブロック（文体見本・過去の修正パターン）を作る
+    同じ職員が続けて何人分も作成するとき、このブロックはAnthropicのプロンプトキャッシュから読まれる
+    """
+    if not manual_instruction and not dynamic_instruction:
+        return ""
+    parts = [f"【共通の文体・修正パターン】\n以下は{staff_name}さんが書く全ての連絡帳に共通する文体の参考情報です。"]
+    parts += [part for part in (manual_instruction, dynamic_instruction) if part]
+    return "\n\n".join(parts)
+
+def estimate_tokens(text):
+    """トークン数の概算（日本語などASCII以外は1文字1トークン、ASCIIは4文字1トークン）"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+def _truncate_to_tokens(text, tokens):
+    suffix = "…（以下省略）"
+    limit = tokens - estimate_tokens(suffix)
+    used = 0.0
+    for i, ch in enumerate(text):
+        used += 0.25 if ord(ch) < 128 else 1
+        if used > limit:
+            return text[:i] + suffix
+    return text
+
+@dataclass(frozen=True)
+class BudgetedInputs:
+    """fit_draft_inputs の結果（トークン数の上限に収めたドラフト生成の入力）"""
+    highlighted_memos: tuple
+    normal_memos: tuple
+    past_reports: tuple
+    dynamic_examples: tuple
+    manual_style: str
+    tokens: int
+    cuts: tuple  # 省略・短縮した内容の説明
+
+def fit_draft_inputs(highlighted_memos, normal_memos, past_reports, dynamic_examples, manual_style, budget=None):
+    """
+    ドラフト生成の入力を優先順（HIGHLIGHTメモ → 通常メモ → 過去の連絡帳 → 修正例 → 文体見本）に
+    budget トークンまで詰める。入りきらない項目は残りが DRAFT_MIN_SECTION_TOKENS 以上なら短縮し、
+    それ以降の項目はすべて省略する（同じ入力なら常に同じ結果になる）
+    """
+    remaining = DRAFT_CONTEXT_TOKEN_BUDGET if budget is None else budget
+    sections = [
+        ("印象的な場面のメモ", list(highlighted_memos)),
+        ("メモ", list(normal_memos)),
+        ("過去の連絡帳", list(past_reports)),
+        ("修正例", list(dynamic_examples)),
+        ("文体見本", [manual_style] if manual_style else []),
+    ]
+    kept_sections = []
+    cuts = []
+    for label, items in sections:
+        kept = []
+        shortened = False
+        for item in items:
+            cost = estimate_tokens(item)
+            if cost <= remaining:
+                kept.append(item)
+                remaining -= cost
+            elif remaining >= DRAFT_MIN_SECTION_TOKENS:
+                kept.append(_truncate_to_tokens(item, remaining))
+                shortened = True
+                remaining = 0
+            else:
+                remaining = 0
+        if len(kept) < len(items):
+            cuts.append(f"{label} {len(items)}件中{len(items) - len(kept)}件を省略")
+        if shortened:
+            cuts.append(f"{label} 1件を短縮")
+        kept_sections.append(kept)
+    highlighted, normal, reports, examples, style = kept_sections
+    total = sum(estimate_tokens(item) for kept in kept_sections for item in kept)
+    return BudgetedInputs(
+        highlighted_memos=tuple(highlighted), normal_memos=tuple(normal),
+        past_reports=tuple(reports), dynamic_examples=tuple(examples),
+        manual_style=style[0] if style else "", tokens=total, cuts=tuple(cuts),
+    )
+
+def budget_draft_inputs(structured_memos, highlighted_memos, past_reports, dynamic_examples, manual_style):
+    """fetch_todays_memos_with_tags の結果から通常メモを切り出し、fit_draft_inputs に渡す"""
+    normal_text = structured_memos[len("\n".join(highlighted_memos)):].lstrip("\n")
+    # メモ本文に改行が含まれていても1件ずつに分けられるよう、「・HH:MM 」の行頭で区切る
+    normal_memos = re.split(r"\n(?=・\d\d:\d\d )", normal_text) if normal_text else []
+    return fit_draft_inputs(highlighted_memos, normal_memos, past_reports or [], dynamic_examples, manual_style or "")
+
+class DraftResponseCache:
+    """
+    ドラフト生成のリクエスト（モデル・温度・system・messages）のハッシュをキーに応答を保持する
+    ttl 秒を過ぎたもの、max_entries を超えた古いものは捨てる
+    """
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (保存時刻, text)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(request):
+        payload = json.dumps(request, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, text):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), text)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+@st.cache_resource
+def get_draft_cache():
+    return DraftResponseCache(DRAFT_CACHE_TTL, DRAFT_CACHE_MAX_ENTRIES)
+
+def log_draft_usage(child_name, usage):
+    """ドラフト生成のトークン数（プロンプトキャッシュの読み込み・書き込みを含む）をログに出す"""
+    logger.info("draft usage for %s: input=%s cache_read=%s cache_write=%s output=%s",
+                child_name, usage.input_tokens,
+                getattr(usage, "cache_read_input_tokens", 0) or 0,
+                getattr(usage, "cache_creation_input_tokens", 0) or 0,
+                usage.output_tokens)
+
+def generate_draft(child_name, memos, staff_name, manual_style, custom_prompt=None, custom_prompt_internal=None, past_reports=None, on_text=None, context=None, client=None, use_cache=True):
+    """
+    連絡帳ドラフトを生成する
+    on_text を渡すとストリーミングで生成し、受信するたびにそれまでの全文を渡して呼び出す
+    context（DraftContext）を渡すと、修正例・タグ付きメモを取得し直さずにそれを使う
+    client を渡すと anthropic_client の代わりに使う
+    プロンプトが前回と同じなら DRAFT_CACHE_TTL 秒以内の生成結果を返す（use_cache=False で作り直す）
+    """
     
-    dynamic_examples = get_high_diff_examples(staff_name, limit=3)
+    dynamic_examples = list(context.dynamic_examples) if context else get_high_diff_examples(staff_name, limit=3)
+
+    # タグ付きメモ情報を取得（要約済みのメモは要約で置き換える）
+    if context:
+        structured_memos, highlighted_memos = context.structured_memos, list(context.highlighted_memos)
+        memo_summary = context.memo_summary
+    else:
+        memo_summary, summarized_count = fetch_todays_memo_summary(child_name)
+        structured_memos, highlighted_memos = fetch_todays_memos_with_tags(child_name, skip=summarized_count)
+
+    # メモ・過去の連絡帳・修正例・文体見本をトークン数の上限に収める
+    inputs = budget_draft_inputs(structured_memos, highlighted_memos, past_reports, dynamic_examples, manual_style)
+    if inputs.cuts:
+        logger.info("draft inputs for %s cut to %d tokens: %s", child_name, inputs.tokens, ", ".join(inputs.cuts))
+    highlighted_memos = list(inputs.highlighted_memos)
+    structured_memos = "\n".join(highlighted_memos + list(inputs.normal_memos))
+    if memo_summary:
+        structured_memos = f"【ここまでのメモの要約】\n{memo_summary}\n\n【要約後のメモ・印象的な場面のメモ】\n{structured_memos}"
+    past_reports, dynamic_examples, manual_style = list(inputs.past_reports), list(inputs.dynamic_examples), inputs.manual_style
+
     dynamic_instruction = ""
     if dynamic_examples:
         examples_str = "\n\n".join([f"---修正例{i+1}---\n{ex}" for i, ex in enumerate(dynamic_examples)])
@@ -453,9 +2334,22 @@ def generate_draft(child_name, memos, staff_name, manual_style, custom_prompt=No
     if manual_style:
         manual_instruction = f"【{staff_name}さんの文体見本（コピペ）】\n{manual_style}\n※口調だけ真似てください。"
 
-    # タグ付きメモ情報を取得
-    structured_memos, highlighted_memos = fetch_todays_memos_with_tags(child_name)
-    
+    # 文体見本・修正例は職員単位で共通なので、systemの先頭ブロックにまとめてプロンプトキャッシュに載せる
+    # （児童ごとに変わるプロンプト本文からは、その先頭ブロックを参照させる）
+    # 先頭ブロックは両方のプロンプトに効くので、使うプロンプト（保護者用・職員用）がすべてその変数を含むものだけを移す。
+    # 変数をあえて外したカスタムプロンプトには、これまでどおり文体見本・修正例を入れない
+    templates = [t for t in (custom_prompt, custom_prompt_internal) if t and t.strip()]
+    move_manual = all("{manual_instruction}" in t for t in templates)
+    move_dynamic = all("{dynamic_instruction}" in t for t in templates)
+    staff_prefix = build_staff_prompt_prefix(staff_name, manual_instruction if move_manual else "",
+                                             dynamic_instruction if move_dynamic else "")
+    if staff_prefix:
+        reference = STAFF_PREFIX_REFERENCE
+        if move_manual and manual_instruction:
+            manual_instruction, reference = reference, ""
+        if move_dynamic and dynamic_instruction:
+            dynamic_instruction, reference = reference, ""
+
     # HIGHLIGHTタグ付きメモがある場合の追加指示
     highlight_instruction = ""
     if highlighted_memos:
@@ -494,43 +2388,269 @@ def generate_draft(child_name, memos, staff_name, manual_style, custom_prompt=No
     # 両方のプロンプトを組み合わせてClaudeに送信
     combined_prompt = f"{guardian_prompt}\n\n<<<INTERNAL>>>\n{internal_prompt}"
 
+    system = [{"type": "text", "text": combined_prompt}]
+    if staff_prefix:
+        system.insert(0, {"type": "text", "text": staff_prefix, "cache_control": {"type": "ephemeral"}})
+    request = dict(
+        model="claude-sonnet-4-5-20250929",
+        max_tokens=2000, temperature=0.3, system=system,
+        messages=[{"role": "user", "content": "下書きを作成してください"}]
+    )
+    cache = get_draft_cache() if DRAFT_CACHE_TTL > 0 else None
+    cache_key = cache.make_key(request) if cache else None
+    if cache and use_cache:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            logger.info("draft cache hit for %s", child_name)
+            if on_text:
+                on_text(cached)
+            return cached
+
+    messages_api = (client or anthropic_client).beta.prompt_caching.messages
+    if on_text is None:
+        try:
+            message = messages_api.create(**request)
+            log_draft_usage(child_name, message.usage)
+            if cache:
+                cache.put(cache_key, message.content[0].text)
+            return message.content[0].text
+        except Exception as e:
+            st.error(f"AI下書き生成エラー: {str(e)}")
+            return DRAFT_ERROR_TEXT
+
+    chunks = []
     try:
-        message = anthropic_client.messages.create(
-            model="claude-sonnet-4-5-20250929",
-            max_tokens=2000, temperature=0.3, system=combined_prompt,
-            messages=[{"role": "user", "content": "下書きを作成してください"}]
-        )
-        return message.content[0].text
+        with messages_api.stream(**request) as stream:
+            for text in stream.text_stream:
+                chunks.append(text)
+                on_text("".join(chunks))
+            log_draft_usage(child_name, stream.get_final_message().usage)
+        if cache:
+            cache.put(cache_key, "".join(chunks))
+        return "".join(chunks)
     except Exception as e:
         st.error(f"AI下書き生成エラー: {str(e)}")
-        return "エラーが発生しました"
+        # 途中まで受信できていれば、その部分を返して一時保存できるようにする
+        return "".join(chunks) or DRAFT_ERROR_TEXT
+
+class TokenBucket:
+    """毎秒 rate 個ずつ補充され、最大 capacity 個までためられるトークンバケット（スレッド間で共有）"""
+    def __init__(self, rate, capacity):
+        if rate <= 0 or capacity < 1:
+            raise ValueError(f"TokenBucket には正の rate と1以上の capacity が必要です: rate={rate}, capacity={capacity}")
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # ロックを持ったまま待つので、待っているスレッドは順番にトークンを受け取る
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+def find_children_pending_draft(child_names):
+    """
+    当日のメモがあり、連絡帳（AIドラフトの一時保存を含む）がまだない児童を返す
+    作成後にメモが増えた先読みドラフトは、ないものとして扱う
+    """
+    today_str = datetime.datetime.now(JST).strftime("%Y-%m-%d")
+    sheet_log = get_sheet_log()
+    pending = []
+    for child in child_names:
+        if not sheet_log.find(child, today_str, "MEMO"):
+            continue
+        reports = sheet_log.find(child, today_str, "REPORT")
+        fingerprint = memo_fingerprint(child, today_str) if reports else None
+        if all(_is_stale_speculative(row, fingerprint) for row in reports):
+            pending.append(child)
+    return pending
+
+class SpeculativeDrafter:
+    """
+    先読みモード（SPECULATIVE_DRAFTS）で、スタッフがボタンを押す前にドラフトを作って一時保存しておく
+    - Tab 2 で児童を開いたとき（request）
+    - メモが stable_minutes 分増えていない児童（1分ごとの巡回）
+    ドラフトは元にしたメモの指紋付きで保存し、生成中にメモが増えた・連絡帳が確定された場合は保存しない
+    同じメモの組み合わせに対しては1回だけ作る
+    """
+    def __init__(self, stable_minutes, directory):
+        self.stable_minutes = stable_minutes
+        self.directory = directory
+        self.pool = ThreadPoolExecutor(max_workers=2)
+        self.jobs = {}  # (child, date) -> (指紋, Future)
+        self.lock = threading.Lock()
+        threading.Thread(target=self._run, name="speculative-drafter", daemon=True).start()
+
+    def request(self, child_name, staff_name, manual_style):
+        """ドラフトがまだなければバックグラウンドで作り始める。戻り値: Future または None"""
+        today_str = datetime.datetime.now(JST).strftime("%Y-%m-%d")
+        fingerprint = memo_fingerprint(child_name, today_str)
+        with self.lock:
+            job = self.jobs.get((child_name, today_str))
+            if job and job[0] == fingerprint:
+                return job[1]
+            if not find_children_pending_draft([child_name]):
+                return None
+            future = self.pool.submit(self._generate, child_name, today_str, staff_name, manual_style, fingerprint)
+            self.jobs[(child_name, today_str)] = (fingerprint, future)
+            return future
+
+    def wait(self, child_name, timeout=90):
+        """今のメモに対する先読みが進行中・完了済みなら、その結果を待って返す（なければ None）"""
+        today_str = datetime.datetime.now(JST).strftime("%Y-%m-%d")
+        with self.lock:
+            job = self.jobs.get((child_name, today_str))
+        if not job or job[0] != memo_fingerprint(child_name, today_str):
+            return None
+        try:
+            return job[1].result(timeout=timeout)
+        except Exception:
+            return None
+
+    def _generate(self, child_name, date_str, staff_name, manual_style, fingerprint):
+        context = assemble_draft_context(child_name, staff_name)
+        if not context.memos:
+            return None
+        draft = generate_draft(child_name, context.memos, staff_name, manual_style,
+                               context.custom_prompt, context.custom_prompt_internal, list(context.past_reports),
+                               context=context)
+        if draft == DRAFT_ERROR_TEXT or memo_fingerprint(child_name, date_str) != fingerprint:
+            return None  # 失敗、または生成中に新しいメモが届いた
+        if not find_children_pending_draft([child_name]):
+            return None  # 生成中に連絡帳が確定された（確定した行の後ろに空の REPORT を足さない）
+        save_ai_draft_temp(child_name, draft, staff_name, fingerprint=fingerprint)
+        logger.info("speculative draft saved for %s", child_name)
+        return draft
+
+    def _run(self):
+        while True:
+            time.sleep(60)
+            try:
+                self.scan()
+            except Exception as e:
+                logger.warning("speculative scan failed: %s", e)
+
+    def scan(self):
+        """メモが stable_minutes 分増えていない、ドラフト未作成の児童の先読みを始める"""
+        now = datetime.datetime.now(JST)
+        today_str = now.strftime("%Y-%m-%d")
+        for child in find_children_pending_draft(self.directory.get_children()):
+            last_memo = get_sheet_log().find(child, today_str, "MEMO")[-1]
+            try:
+                memo_time = JST.localize(datetime.datetime.strptime(last_memo[0], "%Y-%m-%d %H:%M:%S"))
+            except ValueError:
+                # 手で編集された行などで時刻が読めない児童は飛ばし、他の児童の先読みは続ける
+                logger.warning("speculative draft skipped for %s: unparsable memo time %r", child, last_memo[0])
+                continue
+            if (now - memo_time).total_seconds() >= self.stable_minutes * 60 and len(last_memo) > 4:
+                staff_name = last_memo[4]
+                self.request(child, staff_name, self.directory.get_field(staff_name, MEMBER_PROFILE_COL))
+
+@st.cache_resource
+def get_speculative_drafter():
+    return SpeculativeDrafter(SPECULATIVE_STABLE_MINUTES, get_staff_directory())
+
+def generate_pending_drafts(children, staff_name, manual_style, client=None, on_progress=None, limiter=None):
+    """
+    children の下書きを並列に作成し、save_ai_draft_temp で一時保存する（Tab 2 を開くと復元される）
+    同時実行は BULK_DRAFT_WORKERS、LLM呼び出しは limiter（既定は BULK_DRAFT_RPM のトークンバケット）で制限する
+    on_progress(child_name, draft) は完了順に呼び出しスレッドで呼ばれる（失敗時の draft は None）
+    戻り値: {child_name: draft または None}
+    """
+    limiter = limiter or TokenBucket(BULK_DRAFT_RPM / 60, BULK_DRAFT_WORKERS)
+    # Sheetsの読み込みは呼び出しスレッドで先に済ませ、ワーカーはLLM呼び出しと保存だけを行う
+    contexts = {child: assemble_draft_context(child, staff_name) for child in children}
+
+    def run(child):
+        context = contexts[child]
+        limiter.acquire()
+        draft = generate_draft(child, context.memos, staff_name, manual_style,
+                               context.custom_prompt, context.custom_prompt_internal, list(context.past_reports),
+                               context=context, client=client)
+        if draft == DRAFT_ERROR_TEXT:
+            raise RuntimeError(f"{child}さんのドラフト生成に失敗しました")
+        save_ai_draft_temp(child, draft, staff_name)
+        return draft
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=BULK_DRAFT_WORKERS) as pool:
+        futures = {pool.submit(run, child): child for child in children if contexts[child].memos}
+        for future in as_completed(futures):
+            child = futures[future]
+            try:
+                results[child] = future.result()
+            except Exception as e:
+                logger.warning("bulk draft failed for %s: %s", child, e)
+                results[child] = None
+            if on_progress:
+                on_progress(child, results[child])
+    return results
 
 # ---------------------------------------------------------
 # 4. UI実装
 # ---------------------------------------------------------
 
-with st.sidebar:
-    st.title("設定")
-    child_list, staff_list, _ = get_lists_and_profile(None)
-    if not staff_list: staff_list = ["職員A"]
-    selected_staff = st.selectbox("担当職員", staff_list, key="staff_selector")
-    
+def make_draft_stream_renderer(slot, interval=0.15):
+    """
+    ストリーミング中のドラフトを slot（st.empty）に描画するコールバックを返す
+    <<<INTERNAL>>> より前を保護者用、後ろを職員用として分けて表示し、描画は interval 秒ごとに間引く
+    """
+    last_rendered = [0.0]
+    def render(text):
+        now = time.monotonic()
+        if now - last_rendered[0] < interval:
+            return
+        last_rendered[0] = now
+        parts = text.split("<<<INTERNAL>>>", 1)
+        with slot.container():
+            st.caption("✍️ 生成中...")
+            st.markdown("##### 1. 保護者用")
+            st.code(parts[0].strip(), language=None)
+            if len(parts) > 1:
+                st.markdown("##### 2. 職員用（申し送り）")
+                st.code(parts[1].strip(), language=None)
+    return render
+
+def style_input_key(staff_name):
+    return f"style_input_{staff_name}"
+
+def current_style_input(staff_name):
+    """サイドバーの文体マスター欄の入力値（フラグメント単位の再実行をまたいで使うため session_state から読む）"""
+    if style_input_key(staff_name) in st.session_state:
+        return st.session_state[style_input_key(staff_name)]
+    return get_lists_and_profile(staff_name)[2]
+
+@st.fragment
+def render_staff_settings(selected_staff):
+    """
+    文体マスターとプロンプト編集（ここでの操作はこの部分だけを再実行する）
+    プロンプト編集欄は「編集する」をオンにしたときだけ保存済みの内容を読み込む
+    """
     _, _, saved_profile = get_lists_and_profile(selected_staff)
     st.divider()
     st.markdown(f"**✏️ {selected_staff}さんの文体マスター**")
-    style_input = st.text_area("過去の連絡帳（コピペ用）", value=saved_profile, height=200)
-    if st.button("設定を保存"):
-        if save_staff_profile(selected_staff, style_input): st.toast("保存しました")
+    style_input = st.text_area("過去の連絡帳（コピペ用）", value=saved_profile, height=200, key=style_input_key(selected_staff))
+    # プロンプト編集欄の入力値もまとめて保存するため、処理はこの関数の最後で行う
+    save_settings_clicked = st.button("設定を保存", help="文体見本と、編集中のプロンプトをまとめて保存します")
     
     st.divider()
+    custom_prompt_input = prompt_value = None
     with st.expander("**🎯 保護者用プロンプト編集**"):
         st.markdown("保護者向け連絡帳のシステムプロンプトをカスタマイズできます")
-        
-        # 現在保存されているカスタムプロンプトを取得
-        saved_custom_prompt = get_staff_custom_prompt(selected_staff)
-        
-        # デフォルト保護者用プロンプトの生成
-        default_guardian_prompt_template = """
+        if st.toggle("編集する", key=f"edit_guardian_prompt_{selected_staff}"):
+            # 現在保存されているカスタムプロンプトを取得
+            saved_custom_prompt = get_staff_custom_prompt(selected_staff)
+            
+            # デフォルト保護者用プロンプトの生成
+            default_guardian_prompt_template = """
     あなたは放課後等デイサービスの熟練スタッフ「{staff_name}」です。
     提供された「活動中の会話ログ」や「メモ」から、保護者への連絡帳を作成します。
 
@@ -569,36 +2689,38 @@ with st.sidebar:
     [あれば]
     """
         
-        # デフォルト値の設定
-        prompt_value = saved_custom_prompt if saved_custom_prompt else default_guardian_prompt_template.strip()
-        
-        custom_prompt_input = st.text_area(
-            "保護者用カスタムプロンプト",
-            value=prompt_value,
-            height=300,
-            help="空にするとデフォルト保護者用プロンプトが使用されます。{staff_name}, {child_name}, {manual_instruction}, {dynamic_instruction}, {memos}の変数が利用可能です。"
-        )
-        
-        col1, col2 = st.columns(2)
-        with col1:
-            if st.button("保護者用プロンプトを保存", type="primary"):
-                if save_staff_custom_prompt(selected_staff, custom_prompt_input):
-                    st.toast("保護者用プロンプトを保存しました")
-                    
-        with col2:
-            if st.button("保護者用をデフォルトに戻す"):
-                if save_staff_custom_prompt(selected_staff, ""):
-                    st.toast("保護者用をデフォルトプロンプトに戻しました")
-                    st.rerun()
+            # デフォルト値の設定
+            prompt_value = saved_custom_prompt if saved_custom_prompt else default_guardian_prompt_template.strip()
+            
+            custom_prompt_input = st.text_area(
+                "保護者用カスタムプロンプト",
+                value=prompt_value,
+                height=300,
+                help="空にするとデフォルト保護者用プロンプトが使用されます。{staff_name}, {child_name}, {manual_instruction}, {dynamic_instruction}, {memos}の変数が利用可能です。"
+            )
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                if st.button("保護者用プロンプトを保存", type="primary"):
+                    if save_staff_custom_prompt(selected_staff, custom_prompt_input):
+                        st.toast("保護者用プロンプトを保存しました")
+                        st.rerun()
+                        
+            with col2:
+                if st.button("保護者用をデフォルトに戻す"):
+                    if save_staff_custom_prompt(selected_staff, ""):
+                        st.toast("保護者用をデフォルトプロンプトに戻しました")
+                        st.rerun()
 
+    custom_prompt_internal_input = prompt_internal_value = None
     with st.expander("**👥 職員用プロンプト編集（申し送り）**"):
         st.markdown("職員間申し送りのシステムプロンプトをカスタマイズできます")
-        
-        # 現在保存されている内部用カスタムプロンプトを取得
-        saved_custom_prompt_internal = get_staff_custom_prompt_internal(selected_staff)
-        
-        # デフォルト職員用プロンプトの生成
-        default_internal_prompt_template = """
+        if st.toggle("編集する", key=f"edit_internal_prompt_{selected_staff}"):
+            # 現在保存されている内部用カスタムプロンプトを取得
+            saved_custom_prompt_internal = get_staff_custom_prompt_internal(selected_staff)
+            
+            # デフォルト職員用プロンプトの生成
+            default_internal_prompt_template = """
     【職員間申し送り】
     以下の内容を含めて職員間の申し送り事項を作成してください：
 
@@ -617,121 +2739,168 @@ with st.sidebar:
     {dynamic_instruction}
     """
         
-        # デフォルト値の設定
-        prompt_internal_value = saved_custom_prompt_internal if saved_custom_prompt_internal else default_internal_prompt_template.strip()
-        
-        custom_prompt_internal_input = st.text_area(
-            "職員用カスタムプロンプト",
-            value=prompt_internal_value,
-            height=300,
-            help="空にするとデフォルト職員用プロンプトが使用されます。{staff_name}, {child_name}, {manual_instruction}, {dynamic_instruction}, {memos}の変数が利用可能です。"
-        )
-        
-        col1, col2 = st.columns(2)
-        with col1:
-            if st.button("職員用プロンプトを保存", type="primary"):
-                if save_staff_custom_prompt_internal(selected_staff, custom_prompt_internal_input):
-                    st.toast("職員用プロンプトを保存しました")
-                    
-        with col2:
-            if st.button("職員用をデフォルトに戻す"):
-                if save_staff_custom_prompt_internal(selected_staff, ""):
-                    st.toast("職員用をデフォルトプロンプトに戻しました")
-                    st.rerun()
-
-st.title("連絡帳メーカー")
-st.markdown(f'<div class="current-staff">👤 担当者: {selected_staff}</div>', unsafe_allow_html=True)
-
-tab1, tab2 = st.tabs(["1. 録音・記録", "2. 作成・出力"])
-
-# --- Tab 1: 録音・記録 ---
-with tab1:
-    if "audio_key" not in st.session_state: st.session_state.audio_key = 0
-    if "text_key" not in st.session_state: st.session_state.text_key = 0
-
-    # 録音エリア（中央配置）
-    st.markdown("**タップして録音開始 → もう一度タップで停止（最大60秒）**", 
-               help="録音ボタンを押すと録音が開始され、もう一度押すと停止します")
-    audio = st.audio_input("🎙️ 会話・様子を録音", key=f"audio_{st.session_state.audio_key}", 
-                          help="録音ボタンを押して開始、もう一度押して停止")
-    
-    # 児童選択（録音エリアの下に配置）
-    child_name = st.selectbox("対象児童", child_list, 
-                             help="録音後に対象の児童を選択してください")
-
-    col1, col2 = st.columns(2)
-    with col1:
-        # 録音処理
-        if audio:
-            with st.spinner("会話を分析中..."):
-                # get_lists_and_profileから児童名リストを取得
-                child_names, _, _ = get_lists_and_profile()
-                text = transcribe_audio(audio, child_names)
-            if text:
-                # 文字起こし結果を確認・編集用のセッション状態に保存
-                st.session_state[f"transcribed_text_{st.session_state.audio_key}"] = text
-                st.session_state.audio_key += 1
-                st.rerun()
-        
-        # 文字起こし結果の確認・編集エリア
-        current_transcription_key = f"transcribed_text_{st.session_state.audio_key - 1}"
-        if current_transcription_key in st.session_state:
-            transcribed_text = st.text_area(
-                "文字起こし結果（編集可能）",
-                value=st.session_state[current_transcription_key],
-                height=150,
-                key=f"edit_transcription_{st.session_state.audio_key - 1}"
-            )
+            # デフォルト値の設定
+            prompt_internal_value = saved_custom_prompt_internal if saved_custom_prompt_internal else default_internal_prompt_template.strip()
             
-            # 印象的な場面タグ付けチェックボックス
-            is_highlight = st.checkbox(
-                "⭐ 印象的な場面としてタグ付け", 
-                key=f"highlight_audio_{st.session_state.audio_key - 1}"
+            custom_prompt_internal_input = st.text_area(
+                "職員用カスタムプロンプト",
+                value=prompt_internal_value,
+                height=300,
+                help="空にするとデフォルト職員用プロンプトが使用されます。{staff_name}, {child_name}, {manual_instruction}, {dynamic_instruction}, {memos}の変数が利用可能です。"
             )
             
-            col_save, col_cancel = st.columns(2)
-            with col_save:
-                # 保存ボタンは児童が選択されている場合のみ活性化
-                save_disabled = not child_name
-                if st.button("保存する", type="primary", key=f"save_{st.session_state.audio_key - 1}", 
-                           disabled=save_disabled, 
-                           help="児童を選択してから保存してください" if save_disabled else None):
-                    if transcribed_text and save_memo(child_name, transcribed_text, selected_staff, is_highlight):
-                        st.toast("録音を保存しました", icon="🎙️")
-                        del st.session_state[current_transcription_key]
+            col1, col2 = st.columns(2)
+            with col1:
+                if st.button("職員用プロンプトを保存", type="primary"):
+                    if save_staff_custom_prompt_internal(selected_staff, custom_prompt_internal_input):
+                        st.toast("職員用プロンプトを保存しました")
                         st.rerun()
                         
-            with col_cancel:
-                if st.button("キャンセル", key=f"cancel_{st.session_state.audio_key - 1}"):
-                    del st.session_state[current_transcription_key]
-                    st.rerun()
+            with col2:
+                if st.button("職員用をデフォルトに戻す"):
+                    if save_staff_custom_prompt_internal(selected_staff, ""):
+                        st.toast("職員用をデフォルトプロンプトに戻しました")
+                        st.rerun()
 
-    with col2:
-        text_val = st.text_area("補足テキスト", key=f"text_{st.session_state.text_key}", height=100)
+    if save_settings_clicked:
+        # 開いていて、表示時から変更されたプロンプトだけを文体見本と一緒に1回のbatchUpdateで保存
+        # （未編集のデフォルト表示をカスタムプロンプトとして保存しないため）
+        if save_staff_settings(
+            selected_staff,
+            profile_text=style_input,
+            custom_prompt=custom_prompt_input if custom_prompt_input != prompt_value else None,
+            custom_prompt_internal=custom_prompt_internal_input if custom_prompt_internal_input != prompt_internal_value else None,
+        ):
+            st.toast("保存しました")
+            st.rerun()
+
+@st.fragment
+def render_bulk_drafts(child_list, selected_staff):
+    with st.expander("🌙 未作成の下書きを一括作成"):
+        pending_children = find_children_pending_draft(child_list)
+        st.markdown(f"今日のメモがあり、連絡帳が未作成の児童: **{len(pending_children)}人**")
+        if pending_children and st.button("まとめて下書きを作成"):
+            progress = st.progress(0.0)
+            status_slots = {child: st.empty() for child in pending_children}
+            for child, slot in status_slots.items():
+                slot.caption(f"⏳ {child}")
+            finished = []
+            def show_progress(child, draft):
+                finished.append(child)
+                progress.progress(len(finished) / len(pending_children), text=f"{len(finished)} / {len(pending_children)}")
+                status_slots[child].caption(f"✅ {child}" if draft else f"⚠️ {child}（失敗）")
+            try:
+                results = generate_pending_drafts(pending_children, selected_staff, current_style_input(selected_staff), on_progress=show_progress)
+                st.toast(f"{sum(1 for draft in results.values() if draft)}人分の下書きを作成しました")
+            except Exception as e:
+                st.error(f"一括作成エラー: {str(e)}")
+
+@st.fragment
+def render_maintenance():
+    with st.expander("🛠 メンテナンス"):
+        st.markdown("過去の連絡帳の修正量スコア（I列）が未計算の行をまとめて計算します（初回のみ）")
+        if st.button("修正量スコアを一括計算"):
+            try:
+                with st.spinner("計算中..."):
+                    count = backfill_diff_scores()
+                st.toast(f"{count}件のスコアを書き込みました")
+            except Exception as e:
+                st.error(f"スコア計算エラー: {str(e)}")
+        st.markdown("先月以前の記録を月別のアーカイブシートへ移し、毎回の読み込みを今月分だけにします")
+        if st.button("先月以前の記録をアーカイブ"):
+            try:
+                with st.spinner("アーカイブ中..."):
+                    count = archive_old_rows()
+                st.toast(f"{count}行をアーカイブしました")
+            except Exception as e:
+                st.error(f"アーカイブエラー: {str(e)}")
+        rejected = get_write_queue().rejected if WRITE_FLUSH_INTERVAL > 0 else []
+        if rejected:
+            st.markdown(f"**保存できなかった記録: {len(rejected)}件**（内容をコピーして入力し直してください）")
+            for row, reason in rejected:
+                st.caption(f"{row[0]} {row[1]}（{row[3]}）: {reason}")
+                st.code(row[2] or (row[6] if len(row) > 6 else ""), language=None)
+        cache_stats = get_transcript_cache().stats()
+        st.caption(f"文字起こしキャッシュ: ヒット {cache_stats['hits']} / ミス {cache_stats['misses']}"
+                   f"（{cache_stats['entries']}件・{cache_stats['bytes'] // 1024}KB）")
+
+@st.fragment
+def render_transcription_review(child_name, selected_staff):
+    """文字起こし結果の確認・保存（編集中の操作はこの部分だけを再実行する）"""
+    # 文字起こし結果の確認・編集エリア
+    current_transcription_key = f"transcribed_text_{st.session_state.audio_key - 1}"
+    if current_transcription_key in st.session_state:
+        transcribed_text = st.text_area(
+            "文字起こし結果（編集可能）",
+            value=st.session_state[current_transcription_key],
+            height=150,
+            key=f"edit_transcription_{st.session_state.audio_key - 1}"
+        )
+        audio_stats = st.session_state.get("last_audio_stats")
+        if audio_stats and len(audio_stats.data) < audio_stats.original_bytes:
+            st.caption(f"送信サイズ {audio_stats.original_bytes // 1024}KB → {len(audio_stats.data) // 1024}KB"
+                       f"（前処理 {audio_stats.elapsed_ms:.0f}ms）")
+            
         # 印象的な場面タグ付けチェックボックス
-        is_highlight_text = st.checkbox(
+        is_highlight = st.checkbox(
             "⭐ 印象的な場面としてタグ付け", 
-            key=f"highlight_text_{st.session_state.text_key}"
+            key=f"highlight_audio_{st.session_state.audio_key - 1}"
         )
-        # テキストメモの保存ボタンも児童が選択されている場合のみ活性化
-        memo_disabled = not child_name
-        if st.button("追加", disabled=memo_disabled, 
-                    help="児童を選択してからメモを追加してください" if memo_disabled else None):
-            if text_val and save_memo(child_name, text_val, selected_staff, is_highlight_text):
-                st.toast("メモを追加しました", icon="📝")
-                st.session_state.text_key += 1
-                st.rerun()
-
-    st.divider()
+            
+        col_save, col_cancel = st.columns(2)
+        with col_save:
+            # 保存ボタンは児童が選択されている場合のみ活性化
+            save_disabled = not child_name
+            if st.button("保存する", type="primary", key=f"save_{st.session_state.audio_key - 1}", 
+                       disabled=save_disabled, 
+                       help="児童を選択してから保存してください" if save_disabled else None):
+                if transcribed_text and save_memo(child_name, transcribed_text, selected_staff, is_highlight):
+                    st.toast("録音を保存しました", icon="🎙️")
+                    del st.session_state[current_transcription_key]
+                    st.rerun()
+                        
+        with col_cancel:
+            if st.button("キャンセル", key=f"cancel_{st.session_state.audio_key - 1}"):
+                del st.session_state[current_transcription_key]
+                st.rerun(scope="fragment")
+
+@st.fragment
+def render_memo_input(child_name, selected_staff):
+    """補足テキストの入力（入力中の操作はこの部分だけを再実行する）"""
+    text_val = st.text_area("補足テキスト", key=f"text_{st.session_state.text_key}", height=100)
+    # 印象的な場面タグ付けチェックボックス
+    is_highlight_text = st.checkbox(
+        "⭐ 印象的な場面としてタグ付け", 
+        key=f"highlight_text_{st.session_state.text_key}"
+    )
+    # テキストメモの保存ボタンも児童が選択されている場合のみ活性化
+    memo_disabled = not child_name
+    if st.button("追加", disabled=memo_disabled, 
+                help="児童を選択してからメモを追加してください" if memo_disabled else None):
+        if text_val and save_memo(child_name, text_val, selected_staff, is_highlight_text):
+            st.toast("メモを追加しました", icon="📝")
+            st.session_state.text_key += 1
+            st.rerun()
+
+@st.fragment
+def render_todays_memos(child_name):
     st.text_area("本日の記録（AI分析対象）", fetch_todays_memos(child_name), height=200, disabled=True)
 
-# --- Tab 2: 作成・出力 ---
-with tab2:
+@st.fragment
+def render_draft_editor(child_name, selected_staff):
+    """ドラフトの作成・確認・確定（生成や編集の操作はこの部分だけを再実行する）"""
     if "ai_draft" not in st.session_state: st.session_state.ai_draft = ""
     
     # ★重要変更: 児童が選択された時点で、既に保存されたレポートがあるか確認する
     # これにより、別の子の入力後に戻ってきてもデータが消えない
     existing_public, existing_internal = get_todays_report(child_name)
+    # 確定を送信中なら、Sheetsへの反映を待たずに確定後の内容を表示する
+    if child_name in st.session_state.get("saving_reports", {}):
+        existing_public, existing_internal = st.session_state.saving_reports[child_name]
+    # 保存に失敗した編集内容があれば、エディタに戻して再保存できるようにする
+    failed_report = st.session_state.get("failed_reports", {}).get(child_name)
+    if failed_report and not existing_public and not st.session_state.ai_draft:
+        st.session_state.ai_draft = failed_report[0] or failed_report[1]
     
     # ★新機能: セッション状態が空の場合、Google Sheetsから未確定AIドラフトを復元
     if not st.session_state.ai_draft and not existing_public:
@@ -740,6 +2909,10 @@ with tab2:
             st.session_state.ai_draft = restored_draft
             st.info("📄 以前作成したAIドラフトを復元しました")
 
+    # 先読みモード: まだドラフトがなければ、ボタンが押される前からバックグラウンドで作り始める
+    if SPECULATIVE_DRAFTS and not st.session_state.ai_draft and not existing_public:
+        get_speculative_drafter().request(child_name, selected_staff, current_style_input(selected_staff))
+
     # A. 既に本日のレポートが存在する場合（コピペ画面を表示）
     if existing_public:
         st.markdown(f"<div class='saved-badge'>✅ {child_name}さんの本日の連絡帳は作成済みです</div>", unsafe_allow_html=True)
@@ -755,7 +2928,7 @@ with tab2:
         st.divider()
         with st.expander("内容を修正して保存し直す"):
             # 再編集用のエディタ
-            re_edit_text = st.text_area("修正用エディタ", value=f"{existing_public}\n<<<INTERNAL>>>\n{existing_internal}", height=300)
+            re_edit_text = st.text_area("修正用エディタ", value=failed_report[1] if failed_report else f"{existing_public}\n<<<INTERNAL>>>\n{existing_internal}", height=300)
             if st.button("修正版を上書き保存", type="primary"):
                  parts = re_edit_text.split("<<<INTERNAL>>>")
                  pub = parts[0].strip()
@@ -767,20 +2940,41 @@ with tab2:
 
     # B. まだ作成されていない場合（ドラフト作成画面）
     else:
+        regenerate = st.checkbox("同じ内容でも作り直す", help="メモやプロンプトが前回と同じでも、AIに新しく書き直してもらいます")
         if st.button("AIドラフト作成", type="primary", use_container_width=True):
-            memos = fetch_todays_memos(child_name)
-            if not memos:
-                st.error("記録がありません")
+            # 先読み中（または先読み済み）のドラフトがあれば、それを待って使う
+            speculative_draft = None
+            if SPECULATIVE_DRAFTS and not regenerate:
+                with st.spinner("先読み中のドラフトを待っています..."):
+                    speculative_draft = get_speculative_drafter().wait(child_name)
+            st.session_state.get("failed_reports", {}).pop(child_name, None)
+            failed_report = None
+            if speculative_draft:
+                st.session_state.ai_draft = speculative_draft
             else:
-                with st.spinner("会話ログから執筆中（事実と感想を整理しています...）"):
-                    # 過去の連絡帳を取得（最新3件）
-                    past_reports = get_past_reports(child_name, limit=3)
-                    # カスタムプロンプトを取得（保護者用・職員用両方）
-                    custom_prompt = get_staff_custom_prompt(selected_staff)
-                    custom_prompt_internal = get_staff_custom_prompt_internal(selected_staff)
-                    draft = generate_draft(child_name, memos, selected_staff, style_input, custom_prompt, custom_prompt_internal, past_reports)
+                # 当日メモ・過去の連絡帳（最新3件）・カスタムプロンプト（保護者用・職員用）・修正例をまとめて取得
+                try:
+                    with st.spinner("記録を読み込み中..."):
+                        draft_context = assemble_draft_context(child_name, selected_staff)
+                except Exception as e:
+                    st.error(f"データ取得エラー: {str(e)}")
+                    draft_context = None
+                if draft_context and not draft_context.memos:
+                    st.error("記録がありません")
+                elif draft_context:
+                    budgeted = budget_draft_inputs(draft_context.structured_memos, draft_context.highlighted_memos,
+                                                   draft_context.past_reports, draft_context.dynamic_examples, current_style_input(selected_staff))
+                    if budgeted.cuts:
+                        st.caption("✂️ 入力が長いため一部を省略しました: " + "、".join(budgeted.cuts))
+                    # 生成されたそばから表示する（完了後は下の編集エリアに切り替わる）
+                    stream_slot = st.empty()
+                    draft = generate_draft(child_name, draft_context.memos, selected_staff, current_style_input(selected_staff),
+                                           draft_context.custom_prompt, draft_context.custom_prompt_internal, list(draft_context.past_reports),
+                                           on_text=make_draft_stream_renderer(stream_slot), context=draft_context,
+                                           use_cache=not regenerate)
+                    stream_slot.empty()
                     st.session_state.ai_draft = draft
-                    # ★新機能: AIドラフトを一時保存（ページ再読み込み対応）
+                    # ★新機能: AIドラフトを一時保存（ページ再読み込み対応・途中で失敗した場合も受信済みの分を残す）
                     try:
                         save_ai_draft_temp(child_name, draft, selected_staff)
                     except Exception as e:
@@ -788,7 +2982,7 @@ with tab2:
 
         if st.session_state.ai_draft:
             st.divider()
-            final_text = st.text_area("内容の確認・修正", value=st.session_state.ai_draft, height=400)
+            final_text = st.text_area("内容の確認・修正", value=failed_report[1] if failed_report else st.session_state.ai_draft, height=400)
             
             if st.button("この内容で確定・保存", type="primary", use_container_width=True):
                 parts = final_text.split("<<<INTERNAL>>>")
@@ -797,6 +2991,78 @@ with tab2:
                 
                 if save_final_report(child_name, st.session_state.ai_draft, public, internal, selected_staff):
                     st.toast("保存しました！")
-                    # ステートをクリアして再読み込み（そうするとAのブロックに入り、コピペ画面になる）
+                    # ステートをクリアして再読み込み（送信中の内容でAのブロックに入り、コピペ画面になる）
                     st.session_state.ai_draft = ""
                     st.rerun()
+
+@st.fragment(run_every=SAVE_STATUS_POLL_SECONDS or None)
+def render_pending_saves():
+    """送信中の書き込みがある間だけ置き、一定間隔でこの部分だけを再実行して完了・失敗を確認する"""
+    pending, failed = report_finished_saves()
+    if failed or not pending:
+        # 楽観的な表示を確定・巻き戻し、確認もやめるため画面全体を描き直す（トーストは再実行後に表示）
+        st.rerun()
+    st.caption(f"⏳ 保存中...（{pending}件）")
+
+def render_save_status():
+    """画面全体を描くたびに書き込みの完了・失敗を確認し、送信中のものがあるときだけ確認を続ける"""
+    pending, failed = report_finished_saves()
+    if failed:
+        st.rerun()
+    if pending:
+        render_pending_saves()
+
+with st.sidebar:
+    st.title("設定")
+    render_save_status()
+    child_list, staff_list, _ = get_lists_and_profile(None)
+    if not staff_list: staff_list = ["職員A"]
+    selected_staff = st.selectbox("担当職員", staff_list, key="staff_selector")
+    render_staff_settings(selected_staff)
+    render_bulk_drafts(child_list, selected_staff)
+    render_maintenance()
+
+st.title("連絡帳メーカー")
+st.markdown(f'<div class="current-staff">👤 担当者: {selected_staff}</div>', unsafe_allow_html=True)
+
+tab1, tab2 = st.tabs(["1. 録音・記録", "2. 作成・出力"])
+
+# --- Tab 1: 録音・記録 ---
+with tab1:
+    if "audio_key" not in st.session_state: st.session_state.audio_key = 0
+    if "text_key" not in st.session_state: st.session_state.text_key = 0
+
+    # 録音エリア（中央配置）
+    st.markdown("**タップして録音開始 → もう一度タップで停止（長い録音は自動で分割して文字起こしします）**", 
+               help="録音ボタンを押すと録音が開始され、もう一度押すと停止します")
+    audio = st.audio_input("🎙️ 会話・様子を録音", key=f"audio_{st.session_state.audio_key}", 
+                          help="録音ボタンを押して開始、もう一度押して停止")
+    
+    # 児童選択（録音エリアの下に配置）
+    child_name = st.selectbox("対象児童", child_list, 
+                             help="録音後に対象の児童を選択してください")
+
+    col1, col2 = st.columns(2)
+    with col1:
+        # 録音処理
+        if audio:
+            with st.spinner("会話を分析中..."):
+                # get_lists_and_profileから児童名リストを取得
+                child_names, _, _ = get_lists_and_profile()
+                text = transcribe_audio(audio, child_names)
+            if text:
+                # 文字起こし結果を確認・編集用のセッション状態に保存
+                st.session_state[f"transcribed_text_{st.session_state.audio_key}"] = text
+                st.session_state.audio_key += 1
+                st.rerun()
+        render_transcription_review(child_name, selected_staff)
+
+    with col2:
+        render_memo_input(child_name, selected_staff)
+
+    st.divider()
+    render_todays_memos(child_name)
+
+# --- Tab 2: 作成・出力 ---
+with tab2:
+    render_draft_editor(child_name, selected_staff)
@@ -0,0 +1,81 @@
+"""一括ドラフト作成（generate_pending_drafts と TokenBucket）のテスト（app.py は読み込み時に Streamlit と secrets を使うので、関数だけを取り出して実行する）"""
+import ast
+import logging
+import pathlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+
+import pytest
+
+APP = pathlib.Path(__file__).resolve().parent.parent / "app.py"
+DRAFT_ERROR_TEXT = "（生成失敗）"
+
+
+def _load(namespace, *names):
+    tree = ast.parse(APP.read_text(encoding="utf-8"))
+    nodes = [n for n in tree.body if isinstance(n, (ast.FunctionDef, ast.ClassDef)) and n.name in names]
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), str(APP), "exec"), namespace)
+    return namespace
+
+
+class FakeClient:
+    """generate_draft に渡される LLM クライアントの代わり。呼ばれた児童を記録し、固定の下書きを返す"""
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def create(self, child_name):
+        with self.lock:
+            self.calls.append(child_name)
+        if child_name in self.fail:
+            raise RuntimeError("overloaded")
+        return f"{child_name}さんの下書き"
+
+
+def _bulk_namespace(rpm, memos):
+    saved = {}
+
+    def generate_draft(child_name, memos, staff_name, manual_style, custom_prompt, custom_prompt_internal, past_reports, context=None, client=None):
+        try:
+            return client.create(child_name)
+        except Exception:
+            return DRAFT_ERROR_TEXT
+
+    namespace = {
+        "BULK_DRAFT_RPM": rpm, "BULK_DRAFT_WORKERS": 2, "DRAFT_ERROR_TEXT": DRAFT_ERROR_TEXT,
+        "ThreadPoolExecutor": ThreadPoolExecutor, "as_completed": as_completed,
+        "threading": threading, "time": time, "logger": logging.getLogger(__name__),
+        "assemble_draft_context": lambda child, staff: SimpleNamespace(
+            memos=memos.get(child, ""), custom_prompt="", custom_prompt_internal="", past_reports=()),
+        "generate_draft": generate_draft,
+        "save_ai_draft_temp": lambda child, draft, staff: saved.__setitem__(child, draft),
+    }
+    return _load(namespace, "TokenBucket", "generate_pending_drafts"), saved
+
+
+def test_token_bucket_rejects_zero_rate():
+    namespace = _load({"threading": threading, "time": time}, "TokenBucket")
+    with pytest.raises(ValueError):
+        namespace["TokenBucket"](0, 1)
+
+
+def test_bulk_drafts_with_fake_client():
+    namespace, saved = _bulk_namespace(1.0, {"太郎": "・10:00 [佐藤] 積み木", "花子": "・11:00 [佐藤] 絵本", "次郎": ""})
+    client = FakeClient()
+    progress = []
+    results = namespace["generate_pending_drafts"](["太郎", "花子", "次郎"], "佐藤", "", client=client,
+                                                   on_progress=lambda child, draft: progress.append(child))
+    # メモのない児童は呼ばない。RPM が小さくてもバケットの初期容量（同時実行数）の分はすぐ作られる
+    assert results == {"太郎": "太郎さんの下書き", "花子": "花子さんの下書き"}
+    assert saved == results
+    assert sorted(client.calls) == sorted(progress) == ["太郎", "花子"]
+
+
+def test_bulk_drafts_report_failures_per_child():
+    namespace, saved = _bulk_namespace(60.0, {"太郎": "・10:00 [佐藤] 積み木", "花子": "・11:00 [佐藤] 絵本"})
+    results = namespace["generate_pending_drafts"](["太郎", "花子"], "佐藤", "", client=FakeClient(fail={"花子"}))
+    assert results == {"太郎": "太郎さんの下書き", "花子": None}
+    assert saved == {"太郎": "太郎さんの下書き"}
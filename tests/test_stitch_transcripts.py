@@ -0,0 +1,38 @@
+"""_stitch_transcripts の回帰テスト（app.py は読み込み時に Streamlit と secrets を使うので、関数だけを取り出して実行する）"""
+import ast
+import difflib
+import pathlib
+
+APP = pathlib.Path(__file__).resolve().parent.parent / "app.py"
+
+
+def _load(*names):
+    tree = ast.parse(APP.read_text(encoding="utf-8"))
+    nodes = [n for n in tree.body if isinstance(n, ast.FunctionDef) and n.name in names]
+    namespace = {"difflib": difflib}
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), str(APP), "exec"), namespace)
+    return namespace[names[-1]]
+
+
+stitch = _load("_is_fuzzy_overlap", "_stitch_transcripts")
+
+
+def test_keeps_speech_after_shared_sentence_ending():
+    assert stitch(["公園でブロックで遊びました。次に", "次にパズルをしました。最後に帰りました。"]) == \
+        "公園でブロックで遊びました。次にパズルをしました。最後に帰りました。"
+
+
+def test_drops_only_the_overlap():
+    assert stitch(["おやつを食べました。手洗いも", "手洗いもできました。"]) == "おやつを食べました。手洗いもできました。"
+
+
+def test_drops_overlap_transcribed_differently():
+    # 重ねた区間を Whisper が両方のチャンクで少し違う文字列にした場合
+    assert stitch(["おやつを食べました。手洗いもしま", "手洗いをしました。歯みがきもしました。"]) == \
+        "おやつを食べました。手洗いもしました。歯みがきもしました。"
+    assert stitch(["友だちとブロックで遊んで", "友達とブロックで遊んでいました。"]) == "友だちとブロックで遊んでいました。"
+
+
+def test_concatenates_without_overlap():
+    assert stitch(["帰りました。", "雨でした。"]) == "帰りました。雨でした。"
+    assert stitch([]) == ""